@@ -2,30 +2,180 @@
 
 
 import datetime
+import hashlib
+import logging
+import os
+import time
+import pandas as pd
 import pandas_gbq
+import pyarrow as pa
+from mikesnowflake.util.cacheUtil import atomicFile
+
+
+# CACHE_DIR is where we store cached query results which sit by default right outside of the main project.
+FILE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.abspath(os.path.join(FILE_DIR, '..', 'cached_history', 'bq_cache'))
 
 
 class BqAccess(object):
     """this is a pandas-style access class for big query"""
 
-    def __init__(self):
+    def __init__(self, cacheDir=CACHE_DIR, useCache=True, cacheTtl=datetime.timedelta(days=1), maxCacheBytes=2 * 1024 ** 3):
         """init
 
+        Args:
+            cacheDir(str, optional): the path to cached query results (defaults to subdirectory in this project)
+            useCache(bool, optional): caches select query results on disk when True (defaults to True)
+            cacheTtl(datetime.timedelta, optional): how long a cached result is valid (defaults to a day)
+            maxCacheBytes(int, optional): the cache size above which the least recently used results are evicted
+
         Notes:
         This access layer presumes that you have a env variable defined as follows:
         GOOGLE_APPLICATION_CREDENTIALS="<path-to-your-json-auth-file"
         """
+        self.cacheDir = cacheDir
+        self.useCache = useCache
+        self.cacheTtl = cacheTtl
+        self.maxCacheBytes = maxCacheBytes
+
+    @classmethod
+    def __getQueryParameter(cls, name, value):
+        """this is an internal method to return a bq named query parameter for a python value
+        """
+        if isinstance(value, (list, tuple)):
+            return {'name': name,
+                    'parameterType': {'type': 'ARRAY', 'arrayType': {'type': 'STRING'}},
+                    'parameterValue': {'arrayValues': [{'value': str(v)} for v in value]}}
+        if isinstance(value, datetime.datetime):
+            return {'name': name, 'parameterType': {'type': 'TIMESTAMP'}, 'parameterValue': {'value': str(value)}}
+        if isinstance(value, datetime.date):
+            return {'name': name, 'parameterType': {'type': 'DATE'}, 'parameterValue': {'value': str(value)}}
+        if isinstance(value, int):
+            return {'name': name, 'parameterType': {'type': 'INT64'}, 'parameterValue': {'value': str(value)}}
+        return {'name': name, 'parameterType': {'type': 'STRING'}, 'parameterValue': {'value': str(value)}}
+
+    def __getCacheFile(self, sql, params=None):
+        """this is an internal method to return the cache file for a select statement, or None if it isn't cacheable
+        """
+        # we key on the sql exactly as sent. Collapsing whitespace would also collapse it inside string literals
+        # (i.e. LIKE '%FROM  x%'), giving different queries the same entry, and our sql is built the same way each time.
+        if not sql.lstrip().lower().startswith(('select', 'with')):
+            return None
+        if params:
+            sql += ' -- %s' % sorted((k, str(v)) for (k, v) in params.items())
+        key = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, '%s.parquet' % key)
+
+    def __readCache(self, cacheFile):
+        """this is an internal method to read a cached result if it exists and hasn't expired
+        """
+        # another thread or process may evict the file at any point, which is just a cache miss
+        try:
+            stat = os.stat(cacheFile)
+            now = time.time()
+            if now - stat.st_mtime > self.cacheTtl.total_seconds():
+                return None
+
+            df = pd.read_parquet(cacheFile)
+        except FileNotFoundError:
+            return None
+
+        # we track recent use with the access time, since the modified time tells us when the result was cached
+        try:
+            os.utime(cacheFile, (now, stat.st_mtime))
+        except FileNotFoundError:
+            pass
+        logging.info('read cached query result from %s' % cacheFile)
+        return df
 
-    def rawQuery(self, sql):
+    def __writeCache(self, df, cacheFile):
+        """this is an internal method to cache a result, evicting expired and least recently used results
+        """
+        try:
+            with atomicFile(cacheFile) as tmpFile:
+                df.to_parquet(tmpFile)
+        except (ValueError, TypeError, pa.ArrowException) as e:
+            logging.warning('unable to cache query result: %s' % e)
+            return
+        self.evictCache()
+
+    def evictCache(self):
+        """this will remove expired cached results, then the least recently used ones until we're under maxCacheBytes.
+        """
+        if not os.path.isdir(self.cacheDir):
+            return
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            if not name.endswith('.parquet'):
+                continue
+            fileName = os.path.join(self.cacheDir, name)
+            try:
+                stat = os.stat(fileName)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.cacheTtl.total_seconds():
+                self.__removeCacheFile(fileName)
+                continue
+            entries.append((stat.st_atime, stat.st_size, fileName))
+
+        totalBytes = sum(size for (_, size, _) in entries)
+        for _, size, fileName in sorted(entries):
+            if totalBytes <= self.maxCacheBytes:
+                break
+            self.__removeCacheFile(fileName)
+            totalBytes -= size
+            logging.info('evicted cached query result %s' % fileName)
+
+    @classmethod
+    def __removeCacheFile(cls, fileName):
+        """this is an internal method to remove a cached result, which another thread may have removed already
+        """
+        try:
+            os.remove(fileName)
+        except FileNotFoundError:
+            pass
+
+    def clearCache(self):
+        """this will remove every cached query result.
+        """
+        if not os.path.isdir(self.cacheDir):
+            return
+        for name in os.listdir(self.cacheDir):
+            if name.endswith('.parquet'):
+                self.__removeCacheFile(os.path.join(self.cacheDir, name))
+
+    def rawQuery(self, sql, params=None, useCache=None):
         """this will send the sql to BQ and return the results
 
         Args:
             sql(str): the sql string you care about
+            params(dict, optional): named query parameters referenced as @name in the sql. See Notes.
+            useCache(bool, optional): overrides the instance's useCache setting for this query
 
         Returns:
             DataFrame: a pandas.DataFrame of the results
+
+        Notes:
+            parameter values may be strings, ints, dates, datetimes or lists of strings (i.e. for IN UNNEST(@tables)).
+            only select statements are cached. They are keyed on the exact sql, which includes the date window of the
+            query, along with any parameters.
         """
-        df = pandas_gbq.read_gbq(sql)
+        useCache = self.useCache if useCache is None else useCache
+        cacheFile = self.__getCacheFile(sql, params=params) if useCache else None
+        if cacheFile:
+            df = self.__readCache(cacheFile)
+            if df is not None:
+                return df
+
+        if params:
+            queryParameters = [self.__getQueryParameter(name, value) for (name, value) in params.items()]
+            configuration = {'query': {'parameterMode': 'NAMED', 'queryParameters': queryParameters}}
+            df = pandas_gbq.read_gbq(sql, dialect='standard', configuration=configuration)
+        else:
+            df = pandas_gbq.read_gbq(sql)
+        if cacheFile:
+            self.__writeCache(df, cacheFile)
         return df
 
     def deleteTableHistory(self, when, writeToDb=False):
@@ -40,4 +190,4 @@ class BqAccess(object):
                "WHERE query_date = '%s' " % when.date())
         if writeToDb:
             self.rawQuery(sql)
-        return sql
\ No newline at end of file
+        return sql
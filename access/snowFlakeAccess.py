@@ -1,22 +1,46 @@
-import datetime
 from dateutil.parser import parse
+import gzip
+import io
 import logging
 import os
-import shutil
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import pandas as pd
+import pyarrow.parquet as pq
 import snowflake.connector
+from mikesnowflake.util.cacheUtil import CacheStore, getFileHash, loadPickle, dumpPickle
+from mikesnowflake.util.graphUtil import getViewRefs, getViewDepGraph
+from mikesnowflake.util.parquetUtil import toArrowTable
+from mikesnowflake.util.schemaUtil import getSchemaDiff, appendSchemaChanges, getTableChanges
+from mikesnowflake.util.tableUtil import TableNameIndex
 
 
 # CACHE_DIR is where we store cached schema tables and views which sit by default right outside of the main project.
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 CACHE_DIR = os.path.abspath(os.path.join(FILE_DIR, '..', 'cached_history'))
 
+# these are the schemas refreshed by updateSchema. The views of every view schema are kept in views.csv, and tables.csv
+# holds the tables (and views) of the table schemas, followed by the views of the other view schemas.
+VIEW_SCHEMAS = ['prod.mstr_datamart', 'prod.businessintelligence']
+TABLE_SCHEMAS = ['prod.mstr_datamart']
+EXCLUDED_TABLES = ['TEST', 'TS']
+
 
 class SnowFlakeAccess(object):
     """snowflake connection class that uses pandas
+
+    Notes:
+        connections are pooled and reused across queries. Use the class as a context manager (or call close()) to
+        release the pooled sessions when you are done::
+
+            with SnowFlakeAccess(user, password) as sfa:
+                df = sfa.rawQuery(sql)
     """
     def __init__(self, user, password, role='ACCOUNTADMIN', schema='mstr_datamart', database='PROD', warehouse='PROD_OTHER_WH',
-                 cacheDir=CACHE_DIR, verbose=True):
+                 cacheDir=CACHE_DIR, verbose=True, poolSize=4, maxIdleSeconds=300):
         """init
 
         Args:
@@ -28,6 +52,8 @@ class SnowFlakeAccess(object):
             warehouse(str, optional): snowflake warehouse (defaults to 'PROD_OTHER_WH')
             cacheDir(str, optional): the path to cached schema tables and views (defaults to subdirectory in this project)
             verbose(bool, optional): enables verbose printing when True
+            poolSize(int, optional): the maximum number of concurrent snowflake sessions (defaults to 4)
+            maxIdleSeconds(int, optional): pooled sessions idle for longer than this are health checked before reuse
         """
         self.kwargs = {'account': 'openx',
                        'region': 'us-east-1',
@@ -43,6 +69,104 @@ class SnowFlakeAccess(object):
         self.cacheDir = cacheDir
         self.verbose = verbose
 
+        # this is the columnar copy of the cached csv files, which we read instead of parsing the csv each time
+        self.store = CacheStore(cacheDir)
+
+        # this is the connection pool. idle sessions are reused most recent first, and the semaphore bounds
+        # the number of sessions checked out at any time.
+        self.poolSize = poolSize
+        self.maxIdleSeconds = maxIdleSeconds
+        self.__idle = queue.LifoQueue()
+        self.__slots = threading.BoundedSemaphore(poolSize)
+
+    def __enter__(self):
+        """enter"""
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        """exit"""
+        self.close()
+
+    def close(self):
+        """this will close all idle pooled connections.
+        """
+        while True:
+            try:
+                connection, _ = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            self.__discard(connection)
+
+    @classmethod
+    def __discard(cls, connection):
+        """this is an internal method to close a connection, ignoring any errors from stale sessions
+        """
+        try:
+            connection.close()
+        except snowflake.connector.errors.Error as e:
+            logging.warning('error closing snowflake connection: %s' % e)
+
+    def __isHealthy(self, connection, lastUsedTs):
+        """this is an internal method to check that a pooled connection is still usable
+        """
+        if connection.is_closed():
+            return False
+        if time.time() - lastUsedTs < self.maxIdleSeconds:
+            return True
+
+        # the session may have expired on the server, so we ping it before handing it out
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except snowflake.connector.errors.Error as e:
+            logging.info('reconnecting stale snowflake session: %s' % e)
+            return False
+        return True
+
+    def __checkout(self):
+        """this is an internal method to get a healthy idle connection or open a new one
+        """
+        while True:
+            try:
+                connection, lastUsedTs = self.__idle.get_nowait()
+            except queue.Empty:
+                logging.info('opening snowflake connection')
+                return snowflake.connector.connect(**self.kwargs)
+            if self.__isHealthy(connection, lastUsedTs):
+                return connection
+            self.__discard(connection)
+
+    @contextmanager
+    def connection(self):
+        """this will check out a pooled snowflake connection for the duration of a with block.
+
+        Returns:
+            snowflake.connector.SnowflakeConnection: a live snowflake connection
+
+        Notes:
+            connections that fail with an operational (i.e. network or session) error are closed rather than returned
+            to the pool.
+        """
+        self.__slots.acquire()
+        try:
+            connection = self.__checkout()
+            reusable = True
+            try:
+                yield connection
+            except snowflake.connector.errors.OperationalError:
+                reusable = False
+                raise
+            finally:
+                if reusable:
+                    self.__idle.put((connection, time.time()))
+                else:
+                    self.__discard(connection)
+        finally:
+            self.__slots.release()
+
     def rawQuery(self, sql):
         """this method allows users to execute raw queries.
 
@@ -52,13 +176,78 @@ class SnowFlakeAccess(object):
         Returns:
             DataFrame: a pandas.DataFrame of the results
         """
-        try:
-            connection = snowflake.connector.connect(**self.kwargs)
+        with self.connection() as connection:
             df = pd.io.sql.read_sql_query(sql, connection)
-        finally:
-            connection.close()
         return df
 
+    def rawQueries(self, sqls):
+        """this will execute several raw queries concurrently on pooled connections.
+
+        Args:
+            sqls(list of str): the sql statements you want to execute.
+
+        Returns:
+            list of DataFrame: a pandas.DataFrame of the results for each statement, in the same order
+        """
+        with ThreadPoolExecutor(max_workers=self.poolSize) as pool:
+            return list(pool.map(self.rawQuery, sqls))
+
+    def streamQuery(self, sql, fileName, transform=None, batchSize=50000, schema=None):
+        """this will stream the results of a query to a compressed file, one batch at a time.
+
+        Args:
+            sql(str): the sql statement you want to execute.
+            fileName(str): the path of the file to write. See Notes.
+            transform(function, optional): a function applied to each batch DataFrame before it is written
+            batchSize(int, optional): the number of rows fetched per batch (defaults to 50000)
+            schema(pyarrow.Schema, optional): the explicit schema of the file, required for parquet files
+
+        Returns:
+            int: the number of rows written
+
+        Notes:
+            memory stays flat regardless of the size of the result. Files ending in '.parquet' are written as snappy
+            compressed parquet using the schema. Anything else is written as gzipped csv the same way as
+            DataFrame.to_csv(fileName, sep='|') on the full result, with the index running across batches.
+        """
+        isParquet = fileName.endswith('.parquet')
+        if isParquet and schema is None:
+            raise ValueError('a schema is required to stream to parquet file %s' % fileName)
+
+        rows = 0
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(sql)
+                columns = [col[0] for col in cursor.description]
+                if isParquet:
+                    f = pq.ParquetWriter(fileName, schema, compression='snappy')
+                else:
+                    # we leave the timestamp out of the gzip header so the same rows always make the same file
+                    f = io.TextIOWrapper(gzip.GzipFile(fileName, 'wb', mtime=0), encoding='utf-8', newline='')
+                try:
+                    while True:
+                        batch = cursor.fetchmany(batchSize)
+                        if rows > 0 and not batch:
+                            break
+                        df = pd.DataFrame(batch, columns=columns, index=pd.RangeIndex(rows, rows + len(batch)))
+                        if transform:
+                            df = transform(df)
+                        if isParquet:
+                            f.write_table(toArrowTable(df, schema))
+                        else:
+                            df.to_csv(f, sep='|', header=rows == 0)
+                        rows += len(batch)
+                        if not batch:
+                            break
+                finally:
+                    f.close()
+            finally:
+                cursor.close()
+        logging.info('streamed %s rows to %s' % (rows, fileName))
+
+        return rows
+
     def getViews(self):
         """this will read a cached file of view definitions currently in prod.
 
@@ -68,7 +257,7 @@ class SnowFlakeAccess(object):
         fileName = os.path.join(self.cacheDir, 'schema', 'views.csv')
         if self.verbose:
             print('reading files from %s' % fileName)
-        df = pd.read_csv(fileName, sep='|', index_col=0)
+        df = self.store.read(fileName)
 
         return df
 
@@ -80,62 +269,161 @@ class SnowFlakeAccess(object):
         """
         fileName = os.path.join(self.cacheDir, 'schema', 'tables.csv')
         logging.info('reading files from %s' % fileName)
-        df = pd.read_csv(fileName, sep='|', index_col=0)
+        df = self.store.read(fileName)
 
         return sorted(df['TABLE_NAME'].tolist())
 
+    def __getJournalFile(self):
+        """this is an internal method to return the path of the schema change journal
+        """
+        return os.path.join(self.cacheDir, 'schema', 'changes.jsonl')
+
+    def getTableIndex(self):
+        """this will return a compiled index of the cached table names.
+
+        Returns:
+            TableNameIndex: an index used to find table references in sql text
+
+        Notes:
+            the compiled index is cached on disk next to tables.csv and keyed by the hash of that file, so we only
+            rebuild it after the change journal shows that table names were added or removed.
+        """
+        schemaDir = os.path.join(self.cacheDir, 'schema')
+        tableHash = getFileHash(os.path.join(schemaDir, 'tables.csv'))
+        indexFile = os.path.join(schemaDir, 'tableIndex.pkl')
+
+        cached = loadPickle(indexFile)
+        if cached and cached['hash'] == tableHash:
+            logging.info('read table index from %s' % indexFile)
+            return cached['index']
+        if cached and getTableChanges(self.__getJournalFile(), cached['hash'], tableHash) == set():
+            logging.info('table names unchanged, reusing table index from %s' % indexFile)
+            dumpPickle({'hash': tableHash, 'index': cached['index']}, indexFile)
+            return cached['index']
+
+        tableIndex = TableNameIndex(self.getTables())
+        dumpPickle({'hash': tableHash, 'index': tableIndex}, indexFile)
+        logging.info('table index saved to %s' % indexFile)
+
+        return tableIndex
+
+    def getViewGraph(self):
+        """this will return a graph of table names associated with the cached view definitions.
+
+        Returns:
+            networkx.DiGraph: a directed graph of table names and associated views
+
+        Notes:
+            the view edges are persisted next to views.csv along with the hashes of views.csv and tables.csv, and only
+            views whose definitions changed are parsed again. When the table names changed, we also parse the views
+            that mention the tables the change journal says were added or removed.
+        """
+        schemaDir = os.path.join(self.cacheDir, 'schema')
+        viewHash = getFileHash(os.path.join(schemaDir, 'views.csv'))
+        tableHash = getFileHash(os.path.join(schemaDir, 'tables.csv'))
+        cacheFile = os.path.join(schemaDir, 'viewGraph.pkl')
+
+        cached = loadPickle(cacheFile)
+        if cached and cached['viewHash'] == viewHash and cached['tableHash'] == tableHash:
+            logging.info('read view edges from %s' % cacheFile)
+            return getViewDepGraph(cached['viewRefs'])
+
+        # we can only reuse the edges of unchanged views if we know which table names changed
+        previous = None
+        changedTables = None
+        if cached:
+            changedTables = getTableChanges(self.__getJournalFile(), cached['tableHash'], tableHash)
+            if changedTables is not None:
+                previous = cached['viewRefs']
+        viewRefs = getViewRefs(self.getViews(), self.getTableIndex(), previous=previous, changedTables=changedTables)
+        dumpPickle({'viewHash': viewHash, 'tableHash': tableHash, 'viewRefs': viewRefs}, cacheFile)
+        logging.info('view edges saved to %s' % cacheFile)
+
+        return getViewDepGraph(viewRefs)
+
     def backupSchema(self):
-        """this will make copies of the current view and table cached files with a timestamp.
+        """this will snapshot the current view and table cached files with a timestamp.
+
+        Returns:
+            str: the snapshot label, which can be read back with self.store.readSnapshot(label, fileName)
+
+        Notes:
+            snapshots are deduplicated by content, so backing up an unchanged file doesn't store it again.
         """
         if self.verbose:
             print('backing up files')
-        td = datetime.datetime.today()
         schemaDir = os.path.join(self.cacheDir, 'schema')
-
-        # backup tables
         tableFile = os.path.join(schemaDir, 'tables.csv')
-        newTableFile = os.path.join(schemaDir, 'tables_%s.csv' % td.strftime('%Y%m%d%H%M'))
-        cmd = 'cp %s %s' % (tableFile, newTableFile)
-        shutil.copyfile(tableFile, newTableFile)
-        if self.verbose:
-            print("copied %s to %s" % (tableFile, newTableFile))
-
-        # backup views
         viewFile = os.path.join(schemaDir, 'views.csv')
-        newViewFile = os.path.join(schemaDir, 'views_%s.csv' % td.strftime('%Y%m%d%H%M'))
-        shutil.copyfile(viewFile, newViewFile)
+        label = self.store.snapshot([tableFile, viewFile])
         if self.verbose:
-            print("copied %s to %s" % (viewFile, newViewFile))
+            print("recorded snapshot %s of %s and %s" % (label, tableFile, viewFile))
+
+        return label
 
-    def updateSchema(self):
+    def updateSchema(self, viewSchemas=VIEW_SCHEMAS, tableSchemas=TABLE_SCHEMAS):
         """this will ping snowflake db for views and tables, saving them to a location on disk.
+
+        Args:
+            viewSchemas(list of str, optional): the 'database.schema' names whose views we keep (defaults to VIEW_SCHEMAS)
+            tableSchemas(list of str, optional): the 'database.schema' names whose tables we keep (defaults to TABLE_SCHEMAS)
+
+        Returns:
+            dict: the schema diff (see util.schemaUtil.getSchemaDiff)
+
+        Notes:
+            the metadata queries are issued concurrently on pooled sessions, so the refresh takes as long as the slowest
+            query rather than all of them. The differences from the previous schema are appended to the change journal
+            (schema/changes.jsonl), which the cached table index and view graph use to invalidate only what changed.
         """
         schemaDir = os.path.join(self.cacheDir, 'schema')
+        viewFile = os.path.join(schemaDir, 'views.csv')
+        tableFile = os.path.join(schemaDir, 'tables.csv')
 
-        # refresh view file, including business intelligence view info
-        sql = "show views in prod.businessintelligence"
-        logging.info(sql)
-        biViews = self.rawQuery(sql)
+        sqls = ["show views in %s" % schema for schema in viewSchemas]
+        for schema in tableSchemas:
+            database, schemaName = schema.split('.')
+            sqls.append("SELECT table_name " +
+                        "FROM %s.information_schema.tables " % database +
+                        "WHERE table_schema = '%s' " % schemaName.upper() +
+                        "AND table_name not in (%s) " % ', '.join("'%s'" % t for t in EXCLUDED_TABLES) +
+                        "ORDER BY table_name")
+        for sql in sqls:
+            logging.info(sql)
+        results = self.rawQueries(sqls)
+        viewResults = results[:len(viewSchemas)]
+        tableResults = results[len(viewSchemas):]
 
-        sql = "show views in prod.mstr_datamart"
-        logging.info(sql)
-        views = self.rawQuery(sql)
-        views = views.append(biViews, ignore_index=True)
+        # keep the previous schema around for the diff
+        oldViews = pd.DataFrame(columns=['name', 'text'])
+        oldTables = []
+        oldViewHash = oldTableHash = None
+        if os.path.exists(viewFile) and os.path.exists(tableFile):
+            oldViews = self.getViews()
+            oldTables = self.getTables()
+            oldViewHash = getFileHash(viewFile)
+            oldTableHash = getFileHash(tableFile)
 
-        viewFile = os.path.join(schemaDir, 'views.csv')
-        views.to_csv(viewFile, sep='|')
+        # refresh view file
+        views = pd.concat(viewResults, ignore_index=True)
+        self.store.write(views, viewFile)
         logging.info('live view schema saved to %s' % viewFile)
 
-        # refresh table file, incuding views from business intelligence
-        sql = ("SELECT DISTINCT table_name " +
-               "FROM prod.information_schema.columns " +
-               "WHERE table_schema = 'MSTR_DATAMART' " +
-               "AND TABLE_NAME not in ('TEST', 'TS') " +
-               "ORDER BY table_name")
-        logging.info(sql)
-        tables = self.rawQuery(sql)
-        tables = pd.DataFrame(pd.concat([tables['TABLE_NAME'], biViews['name']])).rename(columns={0: 'TABLE_NAME'}).reset_index(drop=True)
+        # refresh table file, including the views from schemas we don't pull tables from (i.e. business intelligence)
+        tableNames = [df['TABLE_NAME'] for df in tableResults]
+        tableSchemas = [schema.lower() for schema in tableSchemas]
+        tableNames += [df['name'] for (schema, df) in zip(viewSchemas, viewResults) if schema.lower() not in tableSchemas]
+        tables = pd.DataFrame({'TABLE_NAME': pd.concat(tableNames, ignore_index=True)})
 
-        tableFile = os.path.join(schemaDir, 'tables.csv')
-        tables.to_csv(tableFile, sep='|')
-        logging.info('live table schema saved to %s' % tableFile)
\ No newline at end of file
+        self.store.write(tables, tableFile)
+        logging.info('live table schema saved to %s' % tableFile)
+
+        # record what changed
+        diff = getSchemaDiff(oldTables, self.getTables(), oldViews, self.getViews())
+        appendSchemaChanges(self.__getJournalFile(), diff, (oldTableHash, getFileHash(tableFile)),
+                            (oldViewHash, getFileHash(viewFile)))
+
+        # refresh the view graph edges for the views that changed
+        self.getViewGraph()
+
+        return diff
\ No newline at end of file
@@ -3,6 +3,7 @@
 
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import pandas as pd
 import numpy as np
@@ -11,7 +12,8 @@ import networkx as nx
 from mikesnowflake.access.snowFlakeAccess import SnowFlakeAccess
 from mikesnowflake.access.bqAccess import BqAccess
 from mikesnowflake.access.colorAccess import ColorAccess
-from mikesnowflake.util.yamlUtil import getYamlConfig
+from mikesnowflake.util.lazyUtil import lazyProperty
+from mikesnowflake.util.yamlUtil import getYamlConfigs
 
 
 GIT_DIR = '/Users/mike.herrera/workspace/data-sustain-snowflake-etl'
@@ -20,7 +22,7 @@ GIT_DIR = '/Users/mike.herrera/workspace/data-sustain-snowflake-etl'
 class SnowFlakeAnalysis(object):
     """this is mike's snowflake analysis class.
     """
-    def __init__(self, startDate, endDate, user, password, gitDir=GIT_DIR, verbose=True, excludeEtl=True):
+    def __init__(self, startDate, endDate, user, password, gitDir=GIT_DIR, verbose=True, excludeEtl=True, pushdown=True):
         """
         Args:
             startDate(datetime.datetime): the start of the analysis period
@@ -30,15 +32,21 @@ class SnowFlakeAnalysis(object):
             gitDir(str, optional): the file directory path location of the git repo for https://github.com/openx/data-sustain-snowflake-etl.
             verbose(bool, optional): prints verbose statements
             excludeEtl(bool, optional): removes SNOWFLAKE_PROD_ETL from queries to reduce table hit noise
+            pushdown(bool, optional): tallies the hit breakdown categories in big query when True. Otherwise we fetch
+                the hits by query type and tally them here (see getCategoryHits).
 
         Notes:
             I'm sure that there's a python library to parse github repos. However, I didn't feel like creating it. So instead, I locally
             downloaded them and used them as references in file paths.
+
+            The gcs tables, hit breakdown, yaml info and dependency graphs (see LAZY_ATTRIBUTES) are computed the first
+            time they're used. Call warm() to compute them all up front in parallel.
         """
         logging.info('initializing snowflake analysis')
         self.startDate = startDate
         self.endDate = endDate
         self.excludeEtl = excludeEtl
+        self.pushdown = pushdown
         self.gitDir = gitDir
 
         # these are the main query types that would register any real usage to a system
@@ -52,13 +60,15 @@ class SnowFlakeAnalysis(object):
                                      'ALTER_SESSION', 'RESTORE',
                                      'CREATE_CONSTRAINT', 'GET_FILES', 'LIST_FILES'],
                            'describe': ['DESCRIBE_QUERY', 'DESCRIBE', 'SHOW',]}
+        self.queryTypeCategories = {col: category for (category, columns) in self.queryTypes.items() for col in columns}
         ca = ColorAccess()
         cols = [col for columns in self.queryTypes.values() for col in columns]
         self.queryTypeColors = dict(zip(cols, ca.getColors(len(cols))))
 
         # this is extra info to allow us to cross reference SnowFlake tables and views.
         self.sfa = SnowFlakeAccess(user, password, verbose=verbose)
-        self.snowFlakeTables = self.sfa.getTables()
+        self.tableIndex = self.sfa.getTableIndex()
+        self.snowFlakeTables = self.tableIndex.tableNames
         self.snowFlakeViewDefs = self.sfa.getViews()
         self.snowFlakeViews = self.snowFlakeViewDefs['name'].tolist()
         logging.info('obtained snowflake tables and views')
@@ -68,31 +78,77 @@ class SnowFlakeAnalysis(object):
         if excludeEtl:
             logging.info("excluding SNOWFLAKE_PROD_ETL user from select statements.")
 
-        # there are snowflake tables that are being unloaded into GCS. We make a note of them here.
-        self.gcsTables = self.__getGcsTables()
-        logging.info('obtained gcs table and view names')
+        logging.info('init complete')
 
-        # we reorder the query types that have the biggest impact
-        logging.info('obtaining hit breakdown')
-        self.hitBreakdown = self.__getHitBreakdown()
+    def __enter__(self):
+        """enter"""
+        return self
 
-        logging.info('getting yaml info')
-        self.yamlInfo = self.__getYamlInfo()
+    def __exit__(self, excType, excValue, traceback):
+        """exit"""
+        self.close()
 
-        logging.info('created view directed graph of dependent table names')
-        self.viewGraph = self.__getViewDepGraph()
+    def close(self):
+        """this will close the pooled snowflake connections. Later queries open new ones.
+        """
+        self.sfa.close()
 
-        # create directed graph of views and dependent tables
-        logging.info('created rollup directed graph of dependent table names')
-        self.rollupGraph = self.__getRollupGraph()
+    # these are the expensive attributes that are computed on first use
+    LAZY_ATTRIBUTES = ['gcsTables', 'hitBreakdown', 'yamlInfo', 'viewGraph', 'rollupGraph', 'tableGraph', 'tableDegrees']
 
-        # create total table dependency graph
-        logging.info('created total table dependency graph')
-        self.tableGraph = nx.compose(self.viewGraph, self.rollupGraph)
-        logging.info('calculating tablename dependency degrees')
-        self.tableDegrees = pd.Series(dict(self.tableGraph.degree())).reindex(self.snowFlakeTables).fillna(0)
+    def warm(self, attributes=None, workers=None):
+        """this will compute the lazy attributes up front, in parallel.
 
-        logging.info('init complete')
+        Args:
+            attributes(list of str, optional): the attributes to compute (defaults to LAZY_ATTRIBUTES)
+            workers(int, optional): the number of threads to use (defaults to one per attribute)
+        """
+        attributes = attributes or self.LAZY_ATTRIBUTES
+        with ThreadPoolExecutor(max_workers=workers or len(attributes)) as pool:
+            list(pool.map(lambda name: getattr(self, name), attributes))
+        logging.info('warmed %s' % attributes)
+
+    @lazyProperty
+    def gcsTables(self):
+        """list of str: there are snowflake tables that are being unloaded into GCS. We make a note of them here."""
+        logging.info('obtaining gcs table and view names')
+        return self.__getGcsTables()
+
+    @lazyProperty
+    def hitBreakdown(self):
+        """DataFrame: table hits by query type category. See __getHitBreakdown."""
+        logging.info('obtaining hit breakdown')
+        return self.__getHitBreakdown(pushdown=self.pushdown)
+
+    @lazyProperty
+    def yamlInfo(self):
+        """DataFrame: the cached yaml config dependencies of each table."""
+        logging.info('getting yaml info')
+        return self.__getYamlInfo()
+
+    @lazyProperty
+    def viewGraph(self):
+        """networkx.DiGraph: a directed graph of table names and associated views."""
+        logging.info('creating view directed graph of dependent table names')
+        return self.__getViewDepGraph()
+
+    @lazyProperty
+    def rollupGraph(self):
+        """networkx.DiGraph: a directed graph of table names and associated rollups."""
+        logging.info('creating rollup directed graph of dependent table names')
+        return self.__getRollupGraph()
+
+    @lazyProperty
+    def tableGraph(self):
+        """networkx.DiGraph: the total table dependency graph of views and rollups."""
+        logging.info('creating total table dependency graph')
+        return nx.compose(self.viewGraph, self.rollupGraph)
+
+    @lazyProperty
+    def tableDegrees(self):
+        """Series: the dependency degree of each table name."""
+        logging.info('calculating tablename dependency degrees')
+        return pd.Series(dict(self.tableGraph.degree())).reindex(self.snowFlakeTables).fillna(0)
 
     def __getRollupGraph(self):
         """this will return a graph of table names associated with rullup processes
@@ -102,10 +158,15 @@ class SnowFlakeAnalysis(object):
         """
         R = nx.DiGraph()
 
-        # parse odfi rollups
+        # parse every rollup config up front, reusing the configs of files that haven't changed
         odfiFiles = sorted(glob(os.path.join(self.gitDir, 'jobs', 'odfi_etls', '*.yaml')))
+        dailyFile = os.path.join(self.gitDir, 'jobs', 'daily_rollups', 'daily_rollups.yaml')
+        monthlyFile = os.path.join(self.gitDir, 'jobs', 'monthly_rollups', 'monthly_rollups.yaml')
+        configs = getYamlConfigs(odfiFiles + [dailyFile, monthlyFile])
+
+        # parse odfi rollups
         for f in odfiFiles:
-            data = getYamlConfig(f)
+            data = configs[f]
             if not 'ROLLUP_CONFIG' in data:
                 continue
 
@@ -124,8 +185,7 @@ class SnowFlakeAnalysis(object):
                     R.add_edge(source, target)
 
         # parse daily rollups
-        dailyFile = os.path.join(self.gitDir, 'jobs', 'daily_rollups', 'daily_rollups.yaml')
-        data = getYamlConfig(dailyFile)
+        data = configs[dailyFile]
         for key in ['ROLL_SQLS', 'ROLL_ADVT_SQLS']:
             for elem in data[key]:
                 target = elem['label'].upper()
@@ -137,8 +197,7 @@ class SnowFlakeAnalysis(object):
                 R.add_edge(source, target)
 
         # parse monthly rollups
-        monthlyFile = os.path.join(self.gitDir, 'jobs', 'monthly_rollups', 'monthly_rollups.yaml')
-        data = getYamlConfig(monthlyFile)
+        data = configs[monthlyFile]
         for key in ['ROLL_SQLS', 'ROLL_ADVT_SQLS']:
             for elem in data[key]:
                 if 'delete' in elem['label']:
@@ -166,9 +225,13 @@ class SnowFlakeAnalysis(object):
 
         return [os.path.basename(p[:-1]).upper() for p in response['prefixes']]
 
-    def __getHitBreakdown(self):
+    def __getHitBreakdown(self, pushdown=True):
         """Get top tables hits for all activity (excluding ETL user) and review tables with specific select hits.
 
+        Args:
+            pushdown(bool, optional): rolls query types up to their categories in big query when True (defaults to True).
+                Otherwise we fetch the hits by query type and roll them up here.
+
         Returns:
             pd.DataFrame: a data frame of tables and corresponding hits. See Notes.
 
@@ -180,30 +243,70 @@ class SnowFlakeAnalysis(object):
             'select' - the collected count of select-like statements made
             'admin' - the collected count of db administrative statements made
             'describe' - the collected count of describe-like statements made
+
+            query types that aren't in self.queryTypes are logged and left out of the tallies. Please update your view
+            definitions as well when you classify them.
         """
-        sql = ("SELECT th.table_name, th.query_type, SUM(th.hits) AS hits "
-               "FROM (SELECT distinct table_name, query_type, query_id, 1 AS hits " +
+        params = self.__getDateParams()
+        sql = ("FROM (SELECT distinct table_name, query_type, query_id, 1 AS hits " +
                "FROM snowflake_test.table_history " +
-               "WHERE query_date between '%s' AND '%s' " % (self.startDate.date(), self.endDate.date()))
-        if self.excludeEtl:
-            sql += ("AND (query_type not in (%s) " % str(self.queryTypes['select']).strip('[]') +
-                    "OR user_name != 'SNOWFLAKE_PROD_ETL') ")
-        sql += (") th " +
-                "GROUP BY th.table_name, th.query_type")
-        df = self.bqa.rawQuery(sql).pivot(index='table_name', columns='query_type', values='hits')
-        df.columns.name = None
+               "WHERE query_date between @startDate AND @endDate " +
+               self.__getEtlFilter(params) +
+               ") th ")
 
-        # we need to confirm that all columns represented in the data frame are accounted for
-        allCols = [col for columns in self.queryTypes.values() for col in columns]
-        missingCols = [c for c in df.columns if c not in allCols]
-        if len(missingCols) > 0:
-            raise ValueError('the following columns were not classified. Please update your view definitions as well\n %s' % missingCols)
+        if not pushdown:
+            sql = ("SELECT th.table_name, th.query_type, SUM(th.hits) AS hits " + sql +
+                   "GROUP BY th.table_name, th.query_type")
+            return self.getCategoryHits(self.bqa.rawQuery(sql, params=params))
 
-        # we create tallies for the various queryType categories
+        # we let big query tally the categories, keeping the query types it couldn't classify for the report
+        cases = ''
         for category, columns in self.queryTypes.items():
-            df[category] = df[[c for c in df.columns if c in columns]].sum(axis=1)
+            cases += "WHEN th.query_type IN UNNEST(@%sTypes) THEN '%s' " % (category, category)
+            params['%sTypes' % category] = columns
+        params['knownTypes'] = list(self.queryTypeCategories)
+        sql = ("SELECT th.table_name, " +
+               "CASE %sEND AS category, " % cases +
+               "IF(th.query_type IN UNNEST(@knownTypes), NULL, th.query_type) AS unknown_type, " +
+               "SUM(th.hits) AS hits " + sql +
+               "GROUP BY 1, 2, 3")
+        df = self.bqa.rawQuery(sql, params=params)
+        self.__reportUnknownQueryTypes(df.loc[df['unknown_type'].notnull(), 'unknown_type'].unique())
+
+        return self.__pivotCategoryHits(df)
+
+    def __reportUnknownQueryTypes(self, unknownTypes):
+        """this is an internal method to log query types that aren't classified in self.queryTypes
+        """
+        if len(unknownTypes) > 0:
+            logging.warning('the following query types were not classified and are left out of the hit breakdown. ' +
+                            'Please update self.queryTypes and your view definitions as well\n %s' % sorted(unknownTypes))
 
-        return df[self.queryTypes.keys()]
+    def __pivotCategoryHits(self, df):
+        """this is an internal method to pivot (table_name, category, hits) rows into a column per category
+        """
+        df = df[df['category'].notnull()]
+        df = df.pivot_table(index='table_name', columns='category', values='hits', aggfunc='sum')
+        df.columns.name = None
+
+        return df.reindex(columns=list(self.queryTypes)).fillna(0)
+
+    def getCategoryHits(self, df):
+        """this will roll table hits by query type up to their query type categories.
+
+        Args:
+            df(DataFrame): the table_name, query_type and hits of each row
+
+        Returns:
+            DataFrame: the hits of each category in self.queryTypes, indexed by table_name (see hitBreakdown)
+
+        Notes:
+            query types that aren't in self.queryTypes are logged and left out.
+        """
+        categories = pd.Categorical(df['query_type'].map(self.queryTypeCategories), categories=list(self.queryTypes))
+        self.__reportUnknownQueryTypes(df.loc[pd.isnull(categories), 'query_type'].unique())
+
+        return self.__pivotCategoryHits(df[['table_name', 'hits']].assign(category=categories.astype(object)))
 
     def __getViewDepGraph(self):
         """this will return a graph of table names associated with view definitions
@@ -211,39 +314,13 @@ class SnowFlakeAnalysis(object):
         Returns:
             networkx.DiGraph: a directed graph of table names and associated views
         """
-        embeddedTableNames = {}  # this will be a dictionary of table names that are substrings of other table names
-        for t1 in self.snowFlakeTables:
-            for t2 in self.snowFlakeTables:
-                if t1 in t2 and t1 != t2:
-                    if t1 not in embeddedTableNames:
-                        embeddedTableNames[t1] = []
-                    embeddedTableNames[t1].append(t2)
-
-        G = nx.DiGraph()
-        for v in self.snowFlakeViews:
-            G.add_node(v)
-            viewDef = self.snowFlakeViewDefs.set_index('name').loc[v, 'text']
-            for t in self.snowFlakeTables:
-                if t.lower() not in viewDef.lower() and t.lower() + ' ' not in viewDef.lower():
-                    continue
-
-                status = True
-                if t in embeddedTableNames:
-                    otherFound = [name for name in embeddedTableNames[t] if name.lower() in viewDef.lower() and name.lower() != v.lower()]
-                    if len(otherFound) > 0:
-                        status = False
-                if status:
-                    if t != v:
-                        if t not in G.nodes():
-                            G.add_node(t)
-                        G.add_edge(t, v)
-        return G
+        return self.sfa.getViewGraph()
 
     def __getYamlInfo(self):
         """
         """
         yamlFile = os.path.join(self.sfa.cacheDir, 'jobs', 'yaml.csv')
-        yaml = pd.read_csv(yamlFile, sep='|', index_col=0)
+        yaml = self.sfa.store.read(yamlFile)
 
         return yaml
 
@@ -289,6 +366,114 @@ class SnowFlakeAnalysis(object):
         df = self.bqa.rawQuery(sql)
         return df
 
+    def __getDateParams(self):
+        """this is an internal method returning the query parameters for the analysis period.
+
+        Returns:
+            dict: the startDate and endDate parameters
+        """
+        return {'startDate': self.startDate.date(), 'endDate': self.endDate.date()}
+
+    def __getEtlFilter(self, params, alias=''):
+        """this is an internal method returning the sql that leaves out the ETL user's select statements.
+
+        Args:
+            params(dict): the query parameters, which get the selectTypes parameter when ETL is excluded
+            alias(str, optional): the table_history alias to qualify the columns with (i.e. 't.')
+
+        Returns:
+            str: the AND clause, or an empty string when self.excludeEtl is False
+        """
+        if not self.excludeEtl:
+            return ''
+        params['selectTypes'] = self.queryTypes['select']
+        return ("AND (%squery_type not in UNNEST(@selectTypes) " % alias +
+                "OR %suser_name != 'SNOWFLAKE_PROD_ETL') " % alias)
+
+    def __getBatchHistory(self, sql, tableNames, chunkSize, params=None):
+        """this is an internal method to run a table history query over many tables, chunking long table lists.
+
+        Args:
+            sql(str): the sql string, which filters table names with IN UNNEST(@tables)
+            tableNames(list of str): the table names you care about
+            chunkSize(int): the most table names sent in a single query
+            params(dict, optional): the other query parameters, sent with every chunk
+
+        Returns:
+            DataFrame: the stacked results indexed by table_name
+        """
+        tableNames = sorted(set(tableNames))
+        dfs = []
+        for i in range(0, len(tableNames), chunkSize):
+            chunkParams = dict(params or {}, tables=tableNames[i:i + chunkSize])
+            dfs.append(self.bqa.rawQuery(sql, params=chunkParams))
+        if len(dfs) == 0:
+            return pd.DataFrame(columns=['table_name']).set_index('table_name')
+
+        return pd.concat(dfs, ignore_index=True).set_index('table_name')
+
+    def getQueryTypeHistories(self, tableNames, chunkSize=1000):
+        """this is the batch version of getQueryTypeHistory, fetching many tables in one round trip.
+
+        Args:
+            tableNames(list of str): the table names you care about
+            chunkSize(int, optional): the most table names sent in a single query (defaults to 1000)
+
+        Returns:
+            DataFrame: a long-format data frame of query_date, query_type and hits indexed by table_name
+        """
+        params = self.__getDateParams()
+        sql = ("SELECT table_name, query_date, query_type, count(query_id) as hits " +
+               "FROM snowflake_test.table_history " +
+               "WHERE query_date between @startDate and @endDate " +
+               "AND table_name IN UNNEST(@tables) " +
+               self.__getEtlFilter(params) +
+               "GROUP BY table_name, query_date, query_type " +
+               "ORDER BY table_name, query_date")
+
+        return self.__getBatchHistory(sql, tableNames, chunkSize, params)
+
+    def getUsageHistories(self, tableNames, queryTypeGroup, chunkSize=1000):
+        """this is the batch version of getUsageHistory, fetching many tables in one round trip.
+
+        Args:
+            tableNames(list of str): the table names you care about
+            queryTypeGroup(str): 'insert', 'select', 'admin', 'describe'. See getUsageHistory.
+            chunkSize(int, optional): the most table names sent in a single query (defaults to 1000)
+
+        Returns:
+            DataFrame: a long-format data frame of query_type, query_date, user_name and hits indexed by table_name
+        """
+        sql = ("SELECT table_name, query_type, query_date, user_name, hits " +
+               "FROM snowflake_test.v_%s_usage " % queryTypeGroup +
+               "WHERE query_date between @startDate and @endDate " +
+               "AND table_name IN UNNEST(@tables) " +
+               "ORDER BY table_name, query_date")
+
+        return self.__getBatchHistory(sql, tableNames, chunkSize, self.__getDateParams())
+
+    def getQueryTextHistories(self, tableNames, chunkSize=1000):
+        """this is the batch version of getQueryTextHistory, fetching many tables in one round trip.
+
+        Args:
+            tableNames(list of str): the table names you care about
+            chunkSize(int, optional): the most table names sent in a single query (defaults to 1000)
+
+        Returns:
+            DataFrame: a long-format data frame of query_date, user_name, query_id, query_type and query_text
+                indexed by table_name
+        """
+        params = {}
+        sql = ("SELECT t.table_name, t.query_date, t.user_name, t.query_id, t.query_type, q.query_text " +
+               "FROM snowflake_test.table_history as t " +
+               "JOIN snowflake_test.query_history q " +
+               "ON q.query_id = t.query_id " +
+               "WHERE t.table_name IN UNNEST(@tables) " +
+               self.__getEtlFilter(params, alias='t.') +
+               "ORDER BY t.table_name, t.query_date")
+
+        return self.__getBatchHistory(sql, tableNames, chunkSize, params)
+
     def printDropCommands(self, tableList):
         """
         """
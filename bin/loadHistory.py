@@ -6,12 +6,23 @@ PROJ_DIR = os.path.dirname(os.path.abspath(os.path.join(__file__, '..', '..')))
 sys.path.append(PROJ_DIR)
 
 import argparse
+import base64
 import datetime
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
 from google.cloud import storage
 from google.cloud import bigquery
 from mikesnowflake.access.snowFlakeAccess import SnowFlakeAccess
 from mikesnowflake.access.bqAccess import BqAccess
+from mikesnowflake.util.cacheUtil import atomicFile, getFileHash, loadPickle, dumpPickle
+from mikesnowflake.util.tableUtil import TableNameIndex
+from mikesnowflake.util.parquetUtil import getArrowSchema, writeParquet
 
 
 os.nice(20)
@@ -23,30 +34,112 @@ DATASET_ID = 'snowflake_test'
 
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/Users/mike.herrera/.config/google/ox-data-devint-8fddac53cd8a.json'
 
+# these are the explicit column definitions of the staged files when using the parquet format
+QUERY_HISTORY_SCHEMA = [('DATABASE_NAME', 'STRING'),
+                        ('SCHEMA_NAME', 'STRING'),
+                        ('USER_NAME', 'STRING'),
+                        ('ROLE_NAME', 'STRING'),
+                        ('WAREHOUSE_NAME', 'STRING'),
+                        ('START_TIME', 'TIMESTAMP'),
+                        ('QUERY_ID', 'STRING'),
+                        ('QUERY_TYPE', 'STRING'),
+                        ('QUERY_TEXT', 'STRING'),
+                        ('QUERY_DATE', 'DATE')]
+# this is the snowflake query history extract, which is filtered further by start time
+QUERY_HISTORY_SQL = ("SELECT DISTINCT DATABASE_NAME, SCHEMA_NAME, USER_NAME, ROLE_NAME, WAREHOUSE_NAME, " +
+                     "START_TIME, QUERY_ID, QUERY_TYPE, QUERY_TEXT " +
+                     "FROM snowflake.account_usage.query_history " +
+                     "WHERE DATABASE_NAME = 'PROD' " +
+                     "AND EXECUTION_STATUS = 'SUCCESS' ")
+# files larger than this are uploaded to gcs in resumable chunks of UPLOAD_CHUNK_SIZE (a multiple of 256KB)
+RESUMABLE_UPLOAD_BYTES = 32 * 1024 ** 2
+UPLOAD_CHUNK_SIZE = 16 * 1024 ** 2
+TABLE_HISTORY_SCHEMA = [('QUERY_DATE', 'DATE'),
+                        ('USER_NAME', 'STRING'),
+                        ('QUERY_ID', 'STRING'),
+                        ('QUERY_TYPE', 'STRING'),
+                        ('TABLE_NAME', 'STRING')]
+
+
+@contextmanager
+def logTiming(stage, when=None):
+    """this will log the wall clock time spent in a stage of the load
+
+    Args:
+        stage(str): the name of the stage (i.e. 'extract', 'upload')
+        when(datetime.datetime, optional): the day being processed, if any
+    """
+    startTs = time.time()
+    try:
+        yield
+    finally:
+        label = stage if when is None else '%s %s' % (stage, when.date())
+        logging.info('[timing] %s took %.2f seconds' % (label, time.time() - startTs))
+
 
 class Loader(object):
     """this is a loader from snowflake usage tables into bigquery"""
 
-    def __init__(self, user, password, projectId=PROJECT_ID, bucketId=BUCKET_ID, datasetId=DATASET_ID):
-        """init"""
-        self.__bqa = BqAccess()
+    def __init__(self, user, password, projectId=PROJECT_ID, bucketId=BUCKET_ID, datasetId=DATASET_ID, stagingFormat='csv',
+                 processes=1):
+        """init
+
+        Args:
+            user(str): snowflake username
+            password(str): snowflake password
+            projectId(str, optional): the gcp project id
+            bucketId(str, optional): the gcs bucket used to stage files
+            datasetId(str, optional): the bq dataset id
+            stagingFormat(str, optional): 'csv' (gzipped csv) or 'parquet' (snappy parquet with an explicit schema)
+            processes(int, optional): the number of processes attributing a day of query history to tables
+        """
+        if stagingFormat not in ('csv', 'parquet'):
+            raise ValueError('unknown staging format %s' % stagingFormat)
+        self.__stagingFormat = stagingFormat
+        self.__processes = processes
+
+        self.__bqa = BqAccess(useCache=False)
         self.__sfa = SnowFlakeAccess(user, password)
-        self.__snowFlakeTables = self.__sfa.getTables()
-        self.__embeddedTableNames = self.__getEmbeddedTableNames()
+        self.__tableIndex = self.__sfa.getTableIndex()
+        self.__snowFlakeTables = self.__tableIndex.tableNames
 
         self.__cacheDir = self.__sfa.cacheDir
 
+        # this is the cache of query fingerprints and their referenced tables, which is only valid for the same tables
+        self.__fingerprintFile = os.path.join(self.__cacheDir, 'fingerprints', 'tableRefs.pkl')
+        self.__fingerprintLock = threading.Lock()
+        self.__tableHash = getFileHash(os.path.join(self.__cacheDir, 'schema', 'tables.csv'))
+        cached = loadPickle(self.__fingerprintFile)
+        self.__fingerprints = cached['refs'] if cached and cached['tableHash'] == self.__tableHash else {}
+        logging.info('loaded %s query fingerprints' % len(self.__fingerprints))
+
         self.__projectId = projectId
         self.__bucketId = bucketId
         self.__datasetId = datasetId
 
         self.__bqClient = bigquery.Client(project=self.__projectId)
         self.__queryHistoryTable = self.__bqClient.get_dataset(self.__datasetId).table('query_history')
+        self.__queryHistoryStagingTable = self.__bqClient.get_dataset(self.__datasetId).table('query_history_staging')
         self.__tableHistoryTable = self.__bqClient.get_dataset(self.__datasetId).table('table_history')
 
         self.__gcsClient = storage.Client(project=self.__projectId)
         self.__gcsBucket = self.__gcsClient.get_bucket(self.__bucketId)
 
+        self.__watermarkFile = os.path.join(self.__cacheDir, 'watermarks', 'query_history.json')
+
+        # the parquet columns are only resolved when we stage parquet (see __resolveQueryHistFields), since the csv
+        # files load by position
+        self.__queryHistFields = None
+        self.__queryHistSchema = None
+        if stagingFormat == 'parquet':
+            self.__resolveQueryHistFields()
+            tableHistFields = self.__getLoadFields(self.__tableHistoryTable, TABLE_HISTORY_SCHEMA)
+            self.__tableHistIndex = tableHistFields[0][0] if len(tableHistFields) > len(TABLE_HISTORY_SCHEMA) else None
+            self.__tableHistSchema = getArrowSchema(tableHistFields)
+            self.__queryHistCfg = self.__getParquetJobConfig(self.__queryHistFields)
+            self.__tableHistCfg = self.__getParquetJobConfig(tableHistFields)
+            return
+
         # this is the bq job config for the query history table
         jobCfg = bigquery.LoadJobConfig()
         jobCfg.skip_leading_rows = 1
@@ -68,21 +161,180 @@ class Loader(object):
         jobCfg.write_disposition = 'WRITE_APPEND'
         self.__tableHistCfg = jobCfg
 
-    def __getEmbeddedTableNames(self):
+    def __enter__(self):
+        """enter"""
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        """exit"""
+        self.close()
+
+    def close(self):
+        """this will close the pooled snowflake connections.
         """
+        self.__sfa.close()
+
+    def __getLoadFields(self, table, fields):
+        """this internal method will return the columns a parquet staging file needs to load into a destination table
+
+        Args:
+            table(bigquery.TableReference): the destination table
+            fields(list of tuple): the (column name, bq column type) pairs we stage
+
+        Returns:
+            list of tuple: the (column name, bq column type) pairs of the destination table
+
+        Raises:
+            ValueError: if the destination table doesn't have our columns
+
+        Notes:
+            the csv staging files carry the pandas index as an unnamed leading column, which was loaded by position into
+            the first column of the destination tables. When a table has that extra leading column, we stage the index
+            under its name so parquet loads line up with the csv ones.
+        """
+        aliases = {'INT64': 'INTEGER', 'FLOAT64': 'FLOAT', 'BOOL': 'BOOLEAN'}
+        destination = [(field.name, aliases.get(field.field_type, field.field_type))
+                       for field in self.__bqClient.get_table(table).schema]
+        expected = [(name.upper(), bqType) for (name, bqType) in fields]
+        if [(name.upper(), bqType) for (name, bqType) in destination] == expected:
+            return list(fields)
+        if ([(name.upper(), bqType) for (name, bqType) in destination[1:]] == expected and
+                destination[0][1] == 'INTEGER'):
+            return destination[:1] + list(fields)
+        raise ValueError("%s has the columns %s, which don't match the staged columns %s" %
+                         (table.table_id, destination, list(fields)))
+
+    def __resolveQueryHistFields(self):
+        """this internal method will resolve the parquet columns and staging config of the query history table once
+        """
+        if self.__queryHistFields is not None:
+            return
+        # parquet files are loaded by column name, so they have to carry every column of the destination table
+        queryHistFields = self.__getLoadFields(self.__queryHistoryTable, QUERY_HISTORY_SCHEMA)
+        self.__queryHistIndex = queryHistFields[0][0] if len(queryHistFields) > len(QUERY_HISTORY_SCHEMA) else None
+        self.__queryHistSchema = getArrowSchema(queryHistFields)
+        self.__queryHistStagingCfg = self.__getParquetJobConfig(queryHistFields, writeDisposition='WRITE_TRUNCATE')
+        self.__queryHistFields = queryHistFields
+
+    @classmethod
+    def __addIndexColumn(cls, df, indexName):
+        """this internal method will add the DataFrame index as a column, the way the csv staging files carry it
         """
-        embeddedTableNames = {}  # this will be a dictionary of table names that contain themselves in other table names
-        for t1 in self.__snowFlakeTables:
-            for t2 in self.__snowFlakeTables:
-                if t1 in t2 and t1 != t2:
-                    if t1 not in embeddedTableNames:
-                        embeddedTableNames[t1] = []
-                    embeddedTableNames[t1].append(t2)
+        if indexName:
+            df[indexName] = df.index
+        return df
 
-        return embeddedTableNames
+    @classmethod
+    def __getParquetJobConfig(cls, fields, writeDisposition='WRITE_APPEND'):
+        """this internal method will return a bq job config for parquet files with an explicit schema
 
-    def saveTableHistory(self, when, tableOverride=None, uploadToBq=False):
+        Args:
+            fields(list of tuple): a list of (column name, bq column type) pairs
+            writeDisposition(str, optional): the bq write disposition (defaults to 'WRITE_APPEND')
+
+        Returns:
+            bigquery.LoadJobConfig: the load job config
+        """
+        jobCfg = bigquery.LoadJobConfig()
+        jobCfg.source_format = bigquery.SourceFormat.PARQUET
+        jobCfg.schema = [bigquery.SchemaField(name, bqType) for (name, bqType) in fields]
+        jobCfg.max_bad_records = 0
+        jobCfg.write_disposition = writeDisposition
+        return jobCfg
+
+    def saveFingerprints(self, maxFingerprints=1000000):
+        """this will persist the query fingerprint cache used by saveTableHistory.
+
+        Args:
+            maxFingerprints(int, optional): the most fingerprints we keep, dropping the least recently seen ones first
+        """
+        with self.__fingerprintLock:
+            refs = self.__fingerprints
+            if len(refs) > maxFingerprints:
+                refs = dict(list(refs.items())[-maxFingerprints:])
+            dumpPickle({'tableHash': self.__tableHash, 'refs': refs}, self.__fingerprintFile)
+        logging.info('saved %s query fingerprints to %s' % (len(refs), self.__fingerprintFile))
+
+    @classmethod
+    def __getFileMd5(cls, fileName):
+        """this internal method will return the base64 md5 digest of a file, which is how gcs reports it
+        """
+        md5 = hashlib.md5()
+        with open(fileName, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                md5.update(chunk)
+        return base64.b64encode(md5.digest()).decode('ascii')
+
+    def __uploadFile(self, fileName, blobName):
+        """this internal method will upload a file to the gcs bucket unless the blob already has the same content
+
+        Args:
+            fileName(str): the path of the local file
+            blobName(str): the name of the blob in self.__bucketId
+
+        Returns:
+            str: the gcs uri of the blob
         """
+        uri = os.path.join('gs://', self.__bucketId, blobName)
+        size = os.path.getsize(fileName)
+        existing = self.__gcsBucket.get_blob(blobName)
+        if existing is not None and existing.size == size and existing.md5_hash == self.__getFileMd5(fileName):
+            logging.info('skipped uploading unchanged %s' % uri)
+            return uri
+
+        # large files go up in resumable chunks, so a dropped connection only costs us the current chunk
+        chunkSize = UPLOAD_CHUNK_SIZE if size > RESUMABLE_UPLOAD_BYTES else None
+        startTs = time.time()
+        self.__gcsBucket.blob(blobName, chunk_size=chunkSize).upload_from_filename(fileName)
+        elapsed = max(time.time() - startTs, 1e-6)
+        logging.info('uploaded %s bytes to %s in %.2f seconds (%.0f bytes/sec)' % (size, uri, elapsed, size / elapsed))
+
+        return uri
+
+    def uploadFiles(self, fileNames, blobDir, workers=8):
+        """this will upload files to the gcs bucket concurrently, skipping the ones whose blobs are unchanged.
+
+        Args:
+            fileNames(list of str): the paths of the local files
+            blobDir(str): the blob prefix the files are uploaded under (i.e. 'mike_logs/table_history')
+            workers(int, optional): the number of concurrent uploads (defaults to 8)
+
+        Returns:
+            list of str: the gcs uri of each file, in the same order
+        """
+        blobNames = [os.path.join(blobDir, os.path.basename(fileName)) for fileName in fileNames]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(fileNames)))) as pool:
+            return list(pool.map(self.__uploadFile, fileNames, blobNames))
+
+    def __getAttributionTables(self, tableOverride=None):
+        """this internal method will return the table index and table names a day of query history is attributed to
+
+        Args:
+            tableOverride(str, optional): a single table name to attribute
+
+        Returns:
+            tuple: the TableNameIndex and the list of table names, which is None for the entire snowflake universe
+        """
+        if not tableOverride:
+            logging.info('setting table names to entire snowflake universe')
+            return self.__tableIndex, None
+
+        tableNames = [tableOverride]
+        logging.info('setting table names to %s' % tableNames)
+        # a table outside of the snowflake universe can't be embedded in any other names
+        if tableOverride not in self.__snowFlakeTables:
+            return TableNameIndex(tableNames), tableNames
+        return self.__tableIndex, tableNames
+
+    def __getTableHistory(self, when, tableOverride=None):
+        """this internal method will attribute a day of query history to the table names it references
+
+        Args:
+            when(datetime.datetime): the day you care about
+            tableOverride(str, optional): a single table name to attribute
+
+        Returns:
+            DataFrame: the QUERY_DATE, USER_NAME, QUERY_ID, QUERY_TYPE and TABLE_NAME of each reference
         """
         logging.info('pinging bq query history for %s' % when.date())
         inClause = ' OR '.join(["STRPOS(UPPER(query_text), '%s') != 0" % tableName for tableName in self.__snowFlakeTables])
@@ -90,53 +342,86 @@ class Loader(object):
                "FROM snowflake_test.query_history " +
                "WHERE query_date = '%s' " % when.date() +
                "AND (%s) " % inClause)
-        queryHistory = self.__bqa.rawQuery(sql)
+        with logTiming('table history extract', when):
+            queryHistory = self.__bqa.rawQuery(sql)
         
-        if tableOverride:
-            tableNames = [tableOverride]
-            logging.info('setting table names to %s' % tableNames)
-        else:
-            tableNames = self.__snowFlakeTables
-            logging.info('setting table names to entire snowflake universe')
+        tableIndex, tableNames = self.__getAttributionTables(tableOverride)
+        # the fingerprint cache only holds references into our own table index
+        cache = self.__fingerprints if tableIndex is self.__tableIndex else None
 
         logging.info('iterating through query history to obtain table refs')
-        data = []
-        groupCols = ['user_name', 'query_id', 'query_type', 'query_text', 'query_date']
-        for (user, query_id, query_type, query, dt), _ in queryHistory.groupby(groupCols):
-            for tableName in tableNames:
-                # we generally check that the table name (or equiv string refs are in the query) to continue
-                if tableName.lower() not in query.lower() and tableName.lower() + ' ' not in query.lower():
-                    continue
-
-                # we check that the table name is not contained in other table names to reduce double-counting.
-                # this catches attribution for instances like "DIM_SITES" and "DIM_SITES_TO_OWNERS"
-                status = True
-                if tableName in self.__embeddedTableNames:
-                    otherFound = [name for name in self.__embeddedTableNames[tableName] if name.lower() in query.lower()]
-                    if len(otherFound) > 0:
-                        status = False
-
-                if status:
-                    data.append([dt, user, query_id, query_type, tableName])
-        df = pd.DataFrame(data, columns=['QUERY_DATE', 'USER_NAME', 'QUERY_ID', 'QUERY_TYPE', 'TABLE_NAME'])
-        logging.info('finished collecting table refs')
-
-        # cache to disk, load to gcs then into bq
-        if uploadToBq:
-            baseName = 'tableHits_%s.csv' % when.strftime('%Y%m%d')
-            if tableOverride:
-                baseName = 'tableHits_%s_%s.csv' % (tableOverride, when.strftime('%Y%m%d'))
-            fileName = os.path.join(self.__cacheDir, baseName)
+        with logTiming('table history attribution', when):
+            # a query id identifies a query, so we dedupe on it alone rather than hashing every query text
+            cols = ['query_date', 'user_name', 'query_id', 'query_type', 'query_text']
+            queries = queryHistory[cols].dropna().drop_duplicates('query_id').sort_values(['user_name', 'query_id'])
+
+            # the index checks that the table name is not contained in other table names to reduce double-counting.
+            # this catches attribution for instances like "DIM_SITES" and "DIM_SITES_TO_OWNERS"
+            # the same query shapes come back every day, so we only run the matcher on fingerprints we haven't seen.
+            # days attributed concurrently share the fingerprint cache, so they take turns.
+            with self.__fingerprintLock:
+                numFingerprints = len(cache) if cache is not None else 0
+                rows, tables = tableIndex.findReferencesParallel(queries['query_text'].values, tableNames=tableNames,
+                                                                 cache=cache, processes=self.__processes)
+                if cache is not None:
+                    logging.info('matched %s new query fingerprints' % (len(cache) - numFingerprints))
+            rows = np.frombuffer(rows, dtype=np.int64)
+            tables = np.frombuffer(tables, dtype=np.int64)
+            df = pd.DataFrame({'QUERY_DATE': queries['query_date'].values[rows],
+                               'USER_NAME': queries['user_name'].values[rows],
+                               'QUERY_ID': queries['query_id'].values[rows],
+                               'QUERY_TYPE': queries['query_type'].values[rows],
+                               'TABLE_NAME': np.array(tableIndex.tableNames, dtype=object)[tables]})
+        logging.info('finished collecting %s table refs from %s queries' % (len(df), len(queries)))
+
+        return df
+
+    def __stageTableHistory(self, when, tableOverride=None):
+        """this internal method will attribute a day of query history and write it to a local staging file
+
+        Args:
+            when(datetime.datetime): the day you care about
+            tableOverride(str, optional): a single table name to attribute
 
-            df.to_csv(fileName, sep='|')
-            logging.info('saved %s' % fileName)
+        Returns:
+            str: the path of the staging file
+        """
+        df = self.__getTableHistory(when, tableOverride=tableOverride)
+
+        ext = 'parquet' if self.__stagingFormat == 'parquet' else 'csv'
+        baseName = 'tableHits_%s.%s' % (when.strftime('%Y%m%d'), ext)
+        if tableOverride:
+            baseName = 'tableHits_%s_%s.%s' % (tableOverride, when.strftime('%Y%m%d'), ext)
+        fileName = os.path.join(self.__cacheDir, baseName)
+
+        with logTiming('table history write', when):
+            if self.__stagingFormat == 'parquet':
+                writeParquet(self.__addIndexColumn(df, self.__tableHistIndex), fileName, self.__tableHistSchema)
+            else:
+                df.to_csv(fileName, sep='|')
+        logging.info('saved %s' % fileName)
+
+        return fileName
+
+    def saveTableHistory(self, when, tableOverride=None, uploadToBq=False):
+        """this will attribute a day of query history to table names and stage it to disk.
+
+        Args:
+            when(datetime.datetime): the day you care about
+            tableOverride(str, optional): a single table name to attribute
+            uploadToBq(bool, optional): replaces the day in snowflake_test.table_history when True
 
+        Notes:
+            use saveTableHistories for more than a day, which commits all of the days with one delete and one load.
+        """
+        fileName = self.__stageTableHistory(when, tableOverride=tableOverride)
+
+        # load to gcs then into bq
+        if uploadToBq:
             logging.info('uploading to gcs')
-            blobName = os.path.join('mike_logs', 'table_history', baseName)
-            uri = os.path.join('gs://', self.__bucketId, blobName)
-            blob = self.__gcsBucket.blob(blobName)
-            blob.upload_from_filename(fileName)
-            logging.info('uploaded file to %s' % uri)
+            blobName = os.path.join('mike_logs', 'table_history', os.path.basename(fileName))
+            with logTiming('table history upload', when):
+                uri = self.__uploadFile(fileName, blobName)
 
             # delete previous entries in query history table (noting that tableOverride is only one entry)
             if tableOverride:
@@ -146,129 +431,408 @@ class Loader(object):
             else:
                 delSql = "DELETE FROM snowflake_test.table_history WHERE query_date = '%s' " % when.date()
 
-            self.__bqa.rawQuery(delSql)
+            with logTiming('table history delete', when):
+                self.__bqa.rawQuery(delSql)
             logging.info(delSql)
 
             # load blob into bq using the query history job config
-            load_job = self.__bqClient.load_table_from_uri(uri, self.__tableHistoryTable, job_config=self.__tableHistCfg)
-            logging.info("Starting job %s " % load_job.job_id)
+            with logTiming('table history load', when):
+                load_job = self.__bqClient.load_table_from_uri(uri, self.__tableHistoryTable, job_config=self.__tableHistCfg)
+                logging.info("Starting job %s " % load_job.job_id)
 
-            load_job.result()  # Waits for table load to complete.
+                load_job.result()  # Waits for table load to complete.
             logging.info("Job finished.")
 
-    def __checkQueryJobs(self, jobIds, queryTimeout=60, location='US'):
-        """this internal method will check the state of BQ job ids for the following::
+    def saveTableHistories(self, dates, tableOverride=None, workers=1):
+        """this will attribute query history to table names for many days and replace them in bq in one commit.
+
+        Args:
+            dates(list of datetime.datetime): the days you care about
+            tableOverride(str, optional): a single table name to attribute
+            workers(int, optional): the number of days attributed and written concurrently (defaults to 1)
+
+        Raises:
+            ValueError: if we'd attribute days on several threads with several processes. See Notes.
+
+        Notes:
+            the days are staged independently, then uploaded together. We issue a single delete for all of the days
+            and load every staged file in a single bq job, just like saveQueryHistory.
+
+            multiprocess attribution forks, which isn't safe while other threads may hold locks (i.e. mid download),
+            so it's only allowed when the days are staged one at a time on this thread.
+        """
+        if workers > 1 and self.__processes > 1:
+            raise ValueError('days can be staged on several threads or attributed with several processes, not both')
+        dates = sorted(dates)
+        if len(dates) == 0:
+            return
+
+        def stage(when):
+            return self.__stageTableHistory(when, tableOverride=tableOverride)
+
+        with logTiming('table history staging'):
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    fileNames = list(pool.map(stage, dates))
+            else:
+                fileNames = [stage(when) for when in dates]
+
+        with logTiming('table history upload'):
+            uris = self.uploadFiles(fileNames, os.path.join('mike_logs', 'table_history'))
+
+        # delete previous entries in table history for every day at once (noting that tableOverride is only one entry)
+        delSql = ("DELETE FROM snowflake_test.table_history " +
+                  "WHERE query_date IN (%s) " % ', '.join("'%s'" % when.date() for when in dates))
+        if tableOverride:
+            delSql += "AND table_name = '%s' " % tableOverride
+        with logTiming('table history delete'):
+            delJob = self.__bqClient.query(delSql)
+            logging.info(delSql)
+            # a delete spanning a long backfill can take a while
+            self.__checkQueryJobs([delJob.job_id], queryTimeout=600)
+        logging.info('done deleting dates!')
+
+        with logTiming('table history load'):
+            load_job = self.__bqClient.load_table_from_uri(uris, self.__tableHistoryTable, job_config=self.__tableHistCfg)
+            logging.info("Starting job %s " % load_job.job_id)
+            load_job.result()  # Waits for table load to complete.
+        logging.info("Job finished.")
+
+    def __getAttributionSql(self, when, tableOverride=None):
+        """this internal method will return a bq script that attributes a day of query history to table names.
+
+        Args:
+            when(datetime.datetime): the day you care about
+            tableOverride(str, optional): a single table name to attribute
+
+        Returns:
+            str: the bq script, which deletes the day's table history and inserts the new attribution
+
+        Notes:
+            we send every table name with the longer table names that contain it, and a query is attributed to a table
+            when its text contains the table name but none of those longer names. This is the same rule as
+            TableNameIndex.findReferences.
+        """
+        tableIndex, tableNames = self.__getAttributionTables(tableOverride)
+        if tableNames is None:
+            tableNames = self.__snowFlakeTables
+
+        def quote(name):
+            return "'%s'" % name.replace('\\', '\\\\').replace("'", "\\'")
+
+        tables = ',\n'.join("STRUCT(%s AS table_name, ARRAY<STRING>[%s] AS embedded_names)" %
+                             (quote(tableName), ', '.join(quote(name) for name in tableIndex.embeddedTableNames.get(tableName, [])))
+                             for tableName in tableNames)
+
+        delSql = "DELETE FROM snowflake_test.table_history WHERE query_date = '%s' " % when.date()
+        if tableOverride:
+            delSql += "AND table_name = %s " % quote(tableOverride)
+        sql = (delSql + ";\n" +
+               "INSERT INTO snowflake_test.table_history (QUERY_DATE, USER_NAME, QUERY_ID, QUERY_TYPE, TABLE_NAME)\n" +
+               "SELECT DISTINCT q.query_date, q.user_name, q.query_id, q.query_type, t.table_name " +
+               "FROM snowflake_test.query_history q " +
+               "CROSS JOIN UNNEST([\n%s]) t " % tables +
+               "WHERE q.query_date = '%s' " % when.date() +
+               "AND STRPOS(LOWER(q.query_text), LOWER(t.table_name)) != 0 " +
+               "AND NOT EXISTS (SELECT 1 FROM UNNEST(t.embedded_names) e " +
+               "WHERE STRPOS(LOWER(q.query_text), LOWER(e)) != 0);")
+
+        return sql
+
+    def saveTableHistoryInBq(self, when, tableOverride=None):
+        """this will attribute a day of query history to table names inside bq, writing straight into table_history.
+
+        Args:
+            when(datetime.datetime): the day you care about
+            tableOverride(str, optional): a single table name to attribute
+
+        Notes:
+            this is an alternative to saveTableHistory(when, uploadToBq=True) where no query text leaves bq and the
+            delete and insert run as a single scripted job.
+        """
+        sql = self.__getAttributionSql(when, tableOverride=tableOverride)
+        with logTiming('table history attribution in bq', when):
+            job = self.__bqClient.query(sql)
+            logging.info("Starting job %s " % job.job_id)
+            self.__checkQueryJobs([job.job_id], queryTimeout=600)
+        logging.info("Job finished.")
+
+    def __waitForJob(self, jobId, deadline, location, initialDelay, maxDelay):
+        """this internal method will poll a single BQ job with exponential backoff until it is done or the deadline passes
+
+        Returns:
+            tuple: the last fetched job and the seconds it took to finish (None if it didn't finish by the deadline)
+        """
+        startTs = time.time()
+        delay = initialDelay
+        while True:
+            job = self.__bqClient.get_job(jobId, location=location)
+            if job.state == 'DONE':
+                return job, time.time() - startTs
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return job, None
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, maxDelay)
+
+    def __checkQueryJobs(self, jobIds, queryTimeout=60, location='US', initialDelay=0.5, maxDelay=10):
+        """this internal method will wait on BQ job ids concurrently and check them for the following::
 
              * timeouts
              * query errors for the associated jobs
 
         Args:
             jobIds(list of str): a list of bq job ids
-            queryTimeout(int): a timeout threshold for the queries to complete.
+            queryTimeout(int): a timeout threshold for all of the jobs to complete.
             location(str, optional): the default is 'US' for prebid-data queries.
+            initialDelay(float, optional): the first polling interval in seconds, which doubles on each poll
+            maxDelay(float, optional): the longest polling interval in seconds
 
         Returns:
-            None: this doesn't return anything.
+            dict: the seconds each job id took to finish
 
         Raises:
             ValueError: a value error if there are timeouts or errors. See Notes.
 
         Notes:
+            Each job is polled in its own thread, with backoff, against a shared deadline. The job fetched when it
+            reports DONE is the one we check for errors, so there's no extra status call per job.
             If a timeout occurs, then we raise a message about the job id, the job state and the timeout limit.
             If a query error occurs then we raise a message about the job id, the reason, the complete error message
             and the original query.
         """
-        # we check the job states and ensure that nothing is left hanging.
-        startTs = datetime.datetime.now()
-        status = False
-        timeout = 0
-        while not (status or timeout >= queryTimeout):
-            states = [self.__bqClient.get_job(jobId, location=location).state for jobId in jobIds]
-            if set(states) == {'DONE'}:
-                status = True
-            endTs = datetime.datetime.now()
-            timeout = (endTs - startTs).seconds
-
-        # if status is still False then we have hung somewhere after the timeout.
+        if len(jobIds) == 0:
+            return {}
+
+        # we wait on the jobs concurrently and ensure that nothing is left hanging past the deadline.
+        deadline = time.time() + queryTimeout
+        with ThreadPoolExecutor(max_workers=min(len(jobIds), 16)) as pool:
+            futures = [pool.submit(self.__waitForJob, jobId, deadline, location, initialDelay, maxDelay) for jobId in jobIds]
+            results = [future.result() for future in futures]
+
+        latencies = {}
+        for jobId, (_, latency) in zip(jobIds, results):
+            if latency is not None:
+                latencies[jobId] = latency
+                logging.info('jobId=%s finished in %.2f seconds' % (jobId, latency))
+
+        # if any job isn't done then we have hung somewhere after the timeout.
         # we report the last known states and raise a timeout exeption.
-        if not status:
-            msg = ""
-            for jobId in jobIds:
-                state = self.__bqClient.get_job(jobId, location=location).state
-                if state != 'DONE':
-                    msg += msg + "jobId={} is currently in state {} after {} seconds".format(jobId, state, queryTimeout)
-
+        msg = ''
+        for jobId, (job, latency) in zip(jobIds, results):
+            if latency is None:
+                msg += "jobId={} is currently in state {} after {} seconds\n".format(jobId, job.state, queryTimeout)
+        if msg != '':
             logging.error(msg)
             raise ValueError("timeout: {}".format(msg))
 
         # we also check for any errors and raise an exception
         msg = ''
-        for jobId in jobIds:
-            job = self.__bqClient.get_job(jobId, location=location)
+        for jobId, (job, _) in zip(jobIds, results):
             error = job.error_result
             if error:
-                status = False
                 reason = error['reason']
                 errMsg = error['message']
-                query = job.query
-                msg += (msg +
-                        'jobId=%s returned a query error.\n' % jobId +
+                query = getattr(job, 'query', None)
+                msg += ('jobId=%s returned a query error.\n' % jobId +
                         'reason=%s;\n' % reason +
                         'message=%s;\n' % errMsg +
                         'query="%s";\n\n' % query)
-                logging.error(msg)
         if msg != '':
+            logging.error(msg)
             raise ValueError("query error: {}".format(msg))
 
-    def saveQueryHistory(self, startDate, endDate):
+        return latencies
+
+    @classmethod
+    def __prepareQueryHistory(cls, df):
+        """this internal method will scrub a batch of snowflake query history and derive the query date
+
+        Args:
+            df(DataFrame): a batch of query history rows
+
+        Returns:
+            DataFrame: the same batch with QUERY_TEXT scrubbed of carriage returns and a QUERY_DATE column
         """
+        df['QUERY_TEXT'] = df['QUERY_TEXT'].str.replace('\r', ' ', regex=False)
+        startTime = pd.to_datetime(df['START_TIME'])
+        if startTime.dt.tz is not None:
+            startTime = startTime.dt.tz_localize(None)
+        df['QUERY_DATE'] = startTime.dt.normalize()
+        return df
+
+    def __stageQueryHistory(self, when):
+        """this internal method will extract a day of snowflake query history, save it to disk and upload it to gcs.
+
+        Args:
+            when(datetime.datetime): the day you care about
+
+        Returns:
+            str: the gcs uri of the uploaded file
         """
-        # save query history to GCS
-        uris = []
-        for when in pd.date_range(startDate, endDate):
-            logging.info("pinging snowflake query history for %s" % when.date())
-            startTime = when.replace(hour=0, minute=0, second=0, microsecond=0)
-            endTime = when.replace(hour=23, minute=59, second=59)
-            sql = ("SELECT DISTINCT DATABASE_NAME, SCHEMA_NAME, USER_NAME, ROLE_NAME, WAREHOUSE_NAME, " +
-                   "START_TIME, QUERY_ID, QUERY_TYPE, QUERY_TEXT " +
-                   "FROM snowflake.account_usage.query_history " +
-                   "WHERE DATABASE_NAME = 'PROD' " +
-                   "AND EXECUTION_STATUS = 'SUCCESS' " +
-                   "AND start_time BETWEEN '%s' AND '%s'" % (startTime, endTime))
-            df = self.__sfa.rawQuery(sql)
-            df['QUERY_TEXT'] = df['QUERY_TEXT'].apply(lambda x: x.replace('\r', ' '))
-            df['QUERY_DATE'] = pd.to_datetime(df['START_TIME'].apply(lambda x: x.date()))
-
-            # save file to local disk then upload to gcs bucket blob
-            baseName = 'queryHistory_%s.csv' % when.strftime('%Y%m%d')
-            fileName = os.path.join(self.__cacheDir, baseName)
-            df.to_csv(fileName, sep='|')
-            logging.info('saved to file: %s' % fileName)
+        logging.info("pinging snowflake query history for %s" % when.date())
+        startTime = when.replace(hour=0, minute=0, second=0, microsecond=0)
+        endTime = when.replace(hour=23, minute=59, second=59)
+        sql = (QUERY_HISTORY_SQL + "AND start_time BETWEEN '%s' AND '%s' " % (startTime, endTime) +
+               "ORDER BY START_TIME, QUERY_ID")
+        # stream the results to a local compressed file then upload to gcs bucket blob
+        ext = 'parquet' if self.__stagingFormat == 'parquet' else 'csv.gz'
+
+        def transform(df):
+            df = self.__prepareQueryHistory(df)
+            if self.__stagingFormat == 'parquet':
+                df = self.__addIndexColumn(df, self.__queryHistIndex)
+            return df
+
+        baseName = 'queryHistory_%s.%s' % (when.strftime('%Y%m%d'), ext)
+        fileName = os.path.join(self.__cacheDir, baseName)
+        with logTiming('query history extract', when):
+            self.__sfa.streamQuery(sql, fileName, transform=transform, schema=self.__queryHistSchema)
+        logging.info('saved to file: %s' % fileName)
+
+        logging.info('uploading to gcs')
+        blobName = os.path.join('mike_logs', 'query_history', baseName)
+        with logTiming('query history upload', when):
+            uri = self.__uploadFile(fileName, blobName)
+
+        return uri
+
+    def saveQueryHistory(self, startDate, endDate, workers=1):
+        """this will load snowflake query history for a period into bq.
 
-            logging.info('uploading to gcs')
-            blobName = os.path.join('mike_logs', 'query_history', baseName)
-            uri = os.path.join('gs://', self.__bucketId, blobName)
-            blob = self.__gcsBucket.blob(blobName)
-            blob.upload_from_filename(fileName)
-            logging.info('uploaded file to %s' % uri)
-            uris.append(uri)
+        Args:
+            startDate(datetime.datetime): start date for the period
+            endDate(datetime.datetime): end date for the period
+            workers(int, optional): the number of days extracted, written and uploaded concurrently (defaults to 1)
+
+        Notes:
+            the days are staged independently, but we still issue the deletes together and load every staged file
+            in a single bq job.
+        """
+        # save query history to GCS
+        with logTiming('query history staging'):
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                uris = list(pool.map(self.__stageQueryHistory, pd.date_range(startDate, endDate)))
 
         # delete previous entries in query history table
-        jobIds = []
-        for when in pd.date_range(startDate, endDate):
-            delSql = "DELETE FROM snowflake_test.query_history WHERE query_date = '%s' " % when.date()
-            delJob = self.__bqClient.query(delSql)
-            logging.info(delSql)
-            jobIds.append(delJob.job_id)
-        self.__checkQueryJobs(jobIds)
+        with logTiming('query history delete'):
+            jobIds = []
+            for when in pd.date_range(startDate, endDate):
+                delSql = "DELETE FROM snowflake_test.query_history WHERE query_date = '%s' " % when.date()
+                delJob = self.__bqClient.query(delSql)
+                logging.info(delSql)
+                jobIds.append(delJob.job_id)
+            self.__checkQueryJobs(jobIds)
         logging.info('done deleting dates!')
 
         # load blobs from GCS into bq
-        load_job = self.__bqClient.load_table_from_uri(uris, self.__queryHistoryTable, job_config=self.__queryHistCfg)
-        logging.info("Starting job %s " % load_job.job_id)
-        load_job.result()  # Waits for table load to complete.
+        with logTiming('query history load'):
+            load_job = self.__bqClient.load_table_from_uri(uris, self.__queryHistoryTable, job_config=self.__queryHistCfg)
+            logging.info("Starting job %s " % load_job.job_id)
+            load_job.result()  # Waits for table load to complete.
         logging.info("Job finished.")
 
+    def __readWatermark(self):
+        """this internal method will read the query history high-water mark
+
+        Returns:
+            dict: the 'start_time' (datetime.datetime) and 'query_id' of the last loaded query, or None
+        """
+        if not os.path.exists(self.__watermarkFile):
+            return None
+        with open(self.__watermarkFile) as f:
+            watermark = json.load(f)
+        watermark['start_time'] = pd.Timestamp(watermark['start_time']).to_pydatetime()
+        return watermark
+
+    def __writeWatermark(self, startTime, queryId):
+        """this internal method will persist the query history high-water mark
+
+        Args:
+            startTime(datetime.datetime): the start time of the last loaded query
+            queryId(str): the query id of the last loaded query
+        """
+        with atomicFile(self.__watermarkFile) as tmpFile:
+            with open(tmpFile, 'w') as f:
+                json.dump({'start_time': startTime.isoformat(), 'query_id': queryId}, f)
+        logging.info('query history watermark set to %s (%s)' % (startTime, queryId))
+
+    def saveQueryHistoryIncremental(self, since=None, lookbackMinutes=180):
+        """this will load snowflake query history that arrived since the last run into bq.
+
+        Args:
+            since(datetime.datetime, optional): the start time to load from when there is no watermark yet
+            lookbackMinutes(int, optional): how far behind the watermark we re-read (defaults to 180). See Notes.
+
+        Returns:
+            list of datetime.datetime: the query dates of the rows that were pulled
+
+        Notes:
+            the high-water mark on START_TIME/QUERY_ID is kept in cached_history/watermarks. Snowflake only writes a
+            query into account_usage once it finishes, so long running queries can show up behind the watermark.
+            We re-read the lookback window and merge on QUERY_ID, which makes reruns idempotent.
+        """
+        # the incremental path always stages parquet
+        self.__resolveQueryHistFields()
+        watermark = self.__readWatermark()
+        if watermark:
+            lowerBound = watermark['start_time'] - datetime.timedelta(minutes=lookbackMinutes)
+            logging.info('query history watermark is %s (%s)' % (watermark['start_time'], watermark['query_id']))
+        elif since:
+            lowerBound = since
+        else:
+            raise ValueError('no query history watermark found in %s. Please provide a start time.' % self.__watermarkFile)
+
+        # we keep track of the latest query and the dates we've seen as the batches stream by
+        seen = {'last': None, 'dates': set()}
+
+        def prepare(df):
+            df = self.__prepareQueryHistory(df)
+            if len(df) > 0:
+                last = df.sort_values(['START_TIME', 'QUERY_ID']).iloc[-1]
+                last = (pd.Timestamp(last['START_TIME']).to_pydatetime(), last['QUERY_ID'])
+                if seen['last'] is None or last > seen['last']:
+                    seen['last'] = last
+                seen['dates'].update(df['QUERY_DATE'].unique())
+            return self.__addIndexColumn(df, self.__queryHistIndex)
+
+        logging.info("pinging snowflake query history since %s" % lowerBound)
+        sql = QUERY_HISTORY_SQL + "AND start_time >= '%s'" % lowerBound
+        baseName = 'queryHistory_incremental_%s.parquet' % datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        fileName = os.path.join(self.__cacheDir, baseName)
+        with logTiming('query history incremental extract'):
+            rows = self.__sfa.streamQuery(sql, fileName, transform=prepare, schema=self.__queryHistSchema)
+        if rows == 0:
+            logging.info('no new query history found')
+            return []
+
+        logging.info('uploading to gcs')
+        blobName = os.path.join('mike_logs', 'query_history', baseName)
+        with logTiming('query history incremental upload'):
+            uri = self.__uploadFile(fileName, blobName)
+
+        # load the new rows into a staging table then merge the ones we don't have yet
+        with logTiming('query history incremental load'):
+            load_job = self.__bqClient.load_table_from_uri(uri, self.__queryHistoryStagingTable,
+                                                           job_config=self.__queryHistStagingCfg)
+            logging.info("Starting job %s " % load_job.job_id)
+            load_job.result()  # Waits for table load to complete.
+
+        cols = ', '.join(name for (name, _) in self.__queryHistFields)
+        mergeSql = ("MERGE snowflake_test.query_history T " +
+                    "USING snowflake_test.query_history_staging S " +
+                    "ON T.query_id = S.query_id " +
+                    "WHEN NOT MATCHED THEN INSERT (%s) VALUES (%s)" % (cols, cols))
+        with logTiming('query history incremental merge'):
+            mergeJob = self.__bqClient.query(mergeSql)
+            logging.info(mergeSql)
+            self.__checkQueryJobs([mergeJob.job_id], queryTimeout=600)
+        logging.info('merged %s rows into query history' % rows)
+
+        self.__writeWatermark(*seen['last'])
+
+        return sorted(pd.Timestamp(dt).to_pydatetime() for dt in seen['dates'])
+
 
 def runLoad(args):
     """
@@ -284,14 +848,32 @@ def runLoad(args):
     if args.startDate:
         startDate = datetime.datetime.strptime(args.startDate, '%Y%m%d')
 
-    loader = Loader(args.user, args.password)
-    if args.tableOverride:
-        for when in pd.date_range(startDate, endDate):
-            loader.saveTableHistory(when, tableOverride=args.tableOverride, uploadToBq=True)
-    else:
-        loader.saveQueryHistory(startDate, endDate)
-        for when in pd.date_range(startDate, endDate):
-            loader.saveTableHistory(when, uploadToBq=True)
+    # attribution forks its processes, which isn't safe from inside a pool of threads
+    if args.engine == 'python' and args.workers > 1 and args.processes > 1:
+        raise ValueError('--workers and --processes can not both be greater than 1')
+
+    with Loader(args.user, args.password, stagingFormat=args.stagingFormat, processes=args.processes) as loader:
+
+        def saveTableHistories(dates):
+            # the python engine commits every day at once, while each bq attribution script replaces its own day
+            if args.engine == 'python':
+                loader.saveTableHistories(dates, tableOverride=args.tableOverride, workers=args.workers)
+                return
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                list(pool.map(lambda when: loader.saveTableHistoryInBq(when, tableOverride=args.tableOverride), dates))
+
+        with logTiming('load'):
+            if args.tableOverride:
+                saveTableHistories(pd.date_range(startDate, endDate))
+            elif args.incremental:
+                since = startDate if args.startDate else None
+                dates = loader.saveQueryHistoryIncremental(since=since)
+                saveTableHistories(dates)
+            else:
+                loader.saveQueryHistory(startDate, endDate, workers=args.workers)
+                saveTableHistories(pd.date_range(startDate, endDate))
+        if args.engine == 'python':
+            loader.saveFingerprints()
 
 
 def main():  # pragma: no cover
@@ -303,6 +885,13 @@ def main():  # pragma: no cover
     parser.add_argument("--tableOverride", default=None, help="single table name to load into bq")
     parser.add_argument("--startDate", default=None, help="start date")
     parser.add_argument("--endDate", default=None, help="end date")
+    parser.add_argument("--workers", default=1, type=int, help="number of days processed concurrently")
+    parser.add_argument("--incremental", action='store_true', help="only load query history since the last run")
+    parser.add_argument("--processes", default=1, type=int,
+                        help="number of processes attributing each day's queries to tables (python engine)")
+    parser.add_argument("--engine", default='python', choices=['python', 'bigquery'],
+                        help="where table references are attributed")
+    parser.add_argument("--stagingFormat", default='csv', choices=['csv', 'parquet'], help="gcs staging file format")
     args = parser.parse_args()
 
     logging.getLogger().setLevel(logging.INFO)
@@ -7,10 +7,8 @@ import logging
 PROJ_DIR = os.path.dirname(os.path.abspath(os.path.join(__file__, '..', '..')))
 sys.path.append(PROJ_DIR)
 
-import datetime
 import yaml
 import subprocess
-import shutil
 import pandas as pd
 from mikesnowflake.access.snowFlakeAccess import SnowFlakeAccess
 from mikesnowflake.util.yamlUtil import getYamlDependencies
@@ -21,26 +19,23 @@ os.nice(20)
 def run(args):
     """
     """
-    sfa = SnowFlakeAccess(args.user, args.password)
-
     # update tables and views
-    sfa.backupSchema()
-    sfa.updateSchema()
+    with SnowFlakeAccess(args.user, args.password) as sfa:
+        sfa.backupSchema()
+        sfa.updateSchema()
 
     # update yaml config dependencies
     yamlDir = os.path.join(sfa.cacheDir, 'jobs')
     yamlFile = os.path.join(yamlDir, 'yaml.csv')
 
-    td = datetime.datetime.today()
-
     # backup yaml config dependencies
-    newYamlFile = os.path.join(yamlDir, 'yaml_%s.csv' % td.strftime('%Y%m%d%H%M'))
-    cmd = 'cp %s %s' % (yamlFile, newYamlFile)
-    shutil.copyfile(yamlFile, newYamlFile)
-    logging.info("copied %s to %s" % (yamlFile, newYamlFile))
+    label = sfa.store.snapshot([yamlFile])
+    logging.info("recorded snapshot %s of %s" % (label, yamlFile))
 
-    df = getYamlDependencies(PROJ_DIR)
-    df.to_csv(yamlFile, sep='|')
+    # unless we want a full refresh, we only rematch yaml files that changed since the last run
+    stateFile = os.path.join(yamlDir, 'yamlState.pkl')
+    df = getYamlDependencies(PROJ_DIR, stateFile=stateFile, full=args.full)
+    sfa.store.write(df, yamlFile)
     logging.info('written yaml dependency to %s' % yamlFile)
 
 def main():
@@ -49,6 +44,7 @@ def main():
     parser = argparse.ArgumentParser(description='SnowFlake update schema')
     parser.add_argument("--user", default=None, help="SnowFlake user")
     parser.add_argument("--password", default=None, help="SnowFlake password")
+    parser.add_argument("--full", action='store_true', help="recompute every yaml dependency from scratch")
     args = parser.parse_args()
 
     logging.getLogger().setLevel(logging.INFO)
@@ -0,0 +1,303 @@
+"""cache utilities"""
+
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import uuid
+from contextlib import contextmanager
+import pandas as pd
+import pyarrow as pa
+
+
+def getFileHash(fileName):
+    """this will return the md5 hex digest of a file's contents
+
+    Args:
+        fileName(str): the path of the file you care about
+
+    Returns:
+        str: the md5 hex digest
+    """
+    md5 = hashlib.md5()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def loadPickle(fileName):
+    """this will load a pickled cache file
+
+    Args:
+        fileName(str): the path of the pickle file
+
+    Returns:
+        object: the unpickled object, or None if the file doesn't exist or can't be read
+    """
+    if not os.path.exists(fileName):
+        return None
+    try:
+        with open(fileName, 'rb') as f:
+            return pickle.load(f)
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+@contextmanager
+def atomicFile(fileName):
+    """this will give you a temporary path to write a file to, which replaces the file when the with block succeeds.
+
+    Args:
+        fileName(str): the path of the file you want to write
+
+    Returns:
+        str: the temporary path to write to
+
+    Notes:
+        the temporary file sits next to the file, so the replace is atomic and readers never see partial writes. It is
+        named uniquely, so concurrent writers in any thread or process don't clobber each other's temporary files, and
+        it is removed if the with block raises.
+    """
+    dirName = os.path.dirname(fileName)
+    if dirName:
+        os.makedirs(dirName, exist_ok=True)
+    tmpFile = '%s.%s.tmp' % (fileName, uuid.uuid4().hex)
+    try:
+        yield tmpFile
+        os.replace(tmpFile, fileName)
+    except BaseException:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+
+
+def dumpPickle(obj, fileName):
+    """this will pickle an object to a cache file, replacing the file atomically so readers never see partial writes
+
+    Args:
+        obj(object): the object you want to cache
+        fileName(str): the path of the pickle file
+    """
+    with atomicFile(fileName) as tmpFile:
+        with open(tmpFile, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class CacheStore(object):
+    """this is a versioned, content addressed store of columnar copies of our pipe-delimited cache files.
+
+    Notes:
+        each csv under the cache directory is kept as an arrow ipc (feather v2) file named by the md5 of the csv, with
+        low cardinality string columns stored as categoricals. We only fall back to parsing the csv when it changed
+        behind our back (i.e. a git pull). The csv files stay the export format.
+
+        readTable hands back the arrow table straight off a memory map, without copying it or decoding the
+        categoricals. read converts to pandas, which copies the data, and turns the categoricals back into the object
+        columns the csv reads as unless you ask to keep them.
+
+        snapshots record the content hash of each file at a point in time, so a backup of an unchanged file costs
+        nothing but a manifest entry.
+    """
+
+    # bump this whenever the layout of the stored objects changes. Older stores are ignored and rebuilt.
+    VERSION = 1
+
+    def __init__(self, cacheDir):
+        """init
+
+        Args:
+            cacheDir(str): the cache directory whose csv files we store (i.e. SnowFlakeAccess.cacheDir)
+        """
+        self.cacheDir = cacheDir
+        self.storeDir = os.path.join(cacheDir, 'store')
+        self.objectDir = os.path.join(self.storeDir, 'objects')
+        self.manifestFile = os.path.join(self.storeDir, 'manifest.json')
+        self.__lock = threading.RLock()
+
+    def __readManifest(self):
+        """this is an internal method to read the manifest, starting a new one if it's missing or from another version
+        """
+        manifest = None
+        if os.path.exists(self.manifestFile):
+            with open(self.manifestFile) as f:
+                manifest = json.load(f)
+        if not manifest or manifest.get('version') != self.VERSION:
+            manifest = {'version': self.VERSION, 'files': {}, 'snapshots': []}
+        return manifest
+
+    def __writeManifest(self, manifest):
+        """this is an internal method to replace the manifest atomically
+        """
+        with atomicFile(self.manifestFile) as tmpFile:
+            with open(tmpFile, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def __getName(self, csvFile):
+        """this is an internal method to name a csv file by its path relative to the cache directory
+        """
+        return os.path.relpath(os.path.abspath(csvFile), os.path.abspath(self.cacheDir))
+
+    def __getObjectFile(self, contentHash):
+        """this is an internal method to return the path of a stored object
+        """
+        return os.path.join(self.objectDir, '%s.arrow' % contentHash)
+
+    @classmethod
+    def __getStamp(cls, csvFile):
+        """this is an internal method to return the modified time and size of a file
+        """
+        stat = os.stat(csvFile)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def __writeObject(self, df, contentHash):
+        """this is an internal method to store a DataFrame as an arrow ipc file, using categoricals where it pays off
+        """
+        objectFile = self.__getObjectFile(contentHash)
+        if os.path.exists(objectFile):
+            return
+        df = df.copy()
+        for col in df.columns:
+            if pd.api.types.is_string_dtype(df[col].dtype) and len(df) > 0 and df[col].nunique() <= len(df) // 2:
+                df[col] = df[col].astype('category')
+        table = pa.Table.from_pandas(df)
+
+        with atomicFile(objectFile) as tmpFile:
+            with pa.OSFile(tmpFile, 'wb') as sink:
+                writer = pa.ipc.new_file(sink, table.schema)
+                writer.write_table(table)
+                writer.close()
+
+    def __openObject(self, contentHash):
+        """this is an internal method to open a stored object as an arrow table backed by a memory map
+        """
+        source = pa.memory_map(self.__getObjectFile(contentHash), 'r')
+        return pa.ipc.open_file(source).read_all()
+
+    def __readObject(self, contentHash, categorical=False):
+        """this is an internal method to read a stored object as a DataFrame
+        """
+        df = self.__openObject(contentHash).to_pandas()
+        if categorical:
+            return df
+
+        # by default the categoricals are only a storage detail, so callers get the string columns the csv reads as
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(df[col].cat.categories.dtype)
+        return df
+
+    def __importCsv(self, csvFile, manifest):
+        """this is an internal method to bring a csv file into the store, returning its content hash
+        """
+        name = self.__getName(csvFile)
+        stamp = self.__getStamp(csvFile)
+        entry = manifest['files'].get(name)
+        if entry and entry['stamp'] == stamp and os.path.exists(self.__getObjectFile(entry['hash'])):
+            return entry['hash']
+
+        contentHash = getFileHash(csvFile)
+        if not os.path.exists(self.__getObjectFile(contentHash)):
+            logging.info('importing %s into the cache store' % csvFile)
+            df = pd.read_csv(csvFile, sep='|', index_col=0)
+            self.__writeObject(df, contentHash)
+        manifest['files'][name] = {'stamp': stamp, 'hash': contentHash}
+        self.__writeManifest(manifest)
+
+        return contentHash
+
+    def read(self, csvFile, categorical=False):
+        """this will read a cached file, preferring its columnar copy.
+
+        Args:
+            csvFile(str): the path of the pipe-delimited csv file
+            categorical(bool, optional): keeps the low cardinality string columns as categoricals when True
+
+        Returns:
+            DataFrame: a pandas.DataFrame of the file
+
+        Notes:
+            we always read back the stored object, so the frame is the same whether or not the csv was just imported.
+        """
+        with self.__lock:
+            contentHash = self.__importCsv(csvFile, self.__readManifest())
+        return self.__readObject(contentHash, categorical=categorical)
+
+    def readTable(self, csvFile):
+        """this will read a cached file as an arrow table without copying it.
+
+        Args:
+            csvFile(str): the path of the pipe-delimited csv file
+
+        Returns:
+            pyarrow.Table: the memory mapped table, with the low cardinality string columns dictionary encoded and the
+                csv index kept the way pyarrow.Table.from_pandas keeps it
+        """
+        with self.__lock:
+            contentHash = self.__importCsv(csvFile, self.__readManifest())
+        return self.__openObject(contentHash)
+
+    def write(self, df, csvFile):
+        """this will write a DataFrame to a cached file, exporting it as csv and storing its columnar copy.
+
+        Args:
+            df(DataFrame): the data you care about
+            csvFile(str): the path of the pipe-delimited csv file
+
+        Notes:
+            we store what the csv reads back as, so readers get the same frame from either copy.
+        """
+        df.to_csv(csvFile, sep='|')
+        with self.__lock:
+            self.__importCsv(csvFile, self.__readManifest())
+
+    def snapshot(self, csvFiles):
+        """this will record the current content of cached files as a timestamped snapshot.
+
+        Args:
+            csvFiles(list of str): the paths of the csv files you care about
+
+        Returns:
+            str: the snapshot label (a '%Y%m%d%H%M%S' timestamp)
+        """
+        label = datetime.datetime.today().strftime('%Y%m%d%H%M%S')
+        with self.__lock:
+            manifest = self.__readManifest()
+            files = {}
+            for csvFile in csvFiles:
+                files[self.__getName(csvFile)] = self.__importCsv(csvFile, manifest)
+            manifest['snapshots'].append({'label': label, 'files': files})
+            self.__writeManifest(manifest)
+        logging.info('recorded snapshot %s of %s' % (label, sorted(files)))
+
+        return label
+
+    def getSnapshots(self):
+        """this will return the recorded snapshots
+
+        Returns:
+            list of dict: each snapshot's 'label' and the content hash of each of its 'files', oldest first
+        """
+        with self.__lock:
+            return self.__readManifest()['snapshots']
+
+    def readSnapshot(self, label, csvFile, categorical=False):
+        """this will read a cached file as of a snapshot.
+
+        Args:
+            label(str): the snapshot label
+            csvFile(str): the path of the csv file you care about
+            categorical(bool, optional): keeps the low cardinality string columns as categoricals when True
+
+        Returns:
+            DataFrame: a pandas.DataFrame of the file at the time of the snapshot
+        """
+        name = self.__getName(csvFile)
+        for snapshot in reversed(self.getSnapshots()):
+            if snapshot['label'] == label and name in snapshot['files']:
+                return self.__readObject(snapshot['files'][name], categorical=categorical)
+        raise ValueError('no snapshot %s of %s' % (label, name))
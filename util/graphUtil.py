@@ -0,0 +1,78 @@
+"""graph utilities"""
+
+
+import hashlib
+import logging
+import networkx as nx
+
+
+def getTextHash(text):
+    """this will return the md5 hex digest of a string
+
+    Args:
+        text(str): the text you care about
+
+    Returns:
+        str: the md5 hex digest
+    """
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def getViewRefs(viewDefs, tableIndex, previous=None, changedTables=None):
+    """this will return the table names referenced by each view definition, reusing previous results for unchanged views.
+
+    Args:
+        viewDefs(DataFrame): the view definitions with 'name' and 'text' columns (i.e. SnowFlakeAccess.getViews())
+        tableIndex(TableNameIndex): the index of table names
+        previous(dict, optional): the results of a previous call
+        changedTables(set of str, optional): the table names added or removed since the previous call
+
+    Returns:
+        dict: view names mapped to a (text hash, list of referenced table names) tuple, in the order of viewDefs
+
+    Notes:
+        a view's references can only change with the table names if its definition mentions one of the changed names,
+        so we only parse those views again along with the views whose definitions changed.
+    """
+    previous = previous or {}
+    changedTables = [t.lower() for t in (changedTables or [])]
+    viewRefs = {}
+    parsed = 0
+    for v, viewDef in zip(viewDefs['name'], viewDefs['text']):
+        textHash = getTextHash(viewDef)
+        if v in previous and previous[v][0] == textHash:
+            if not changedTables:
+                viewRefs[v] = previous[v]
+                continue
+            lowerDef = viewDef.lower()
+            if not any(t in lowerDef for t in changedTables):
+                viewRefs[v] = previous[v]
+                continue
+
+        # a view definition contains its own name, so we don't let it hide the tables embedded in that name
+        viewRefs[v] = (textHash, tableIndex.findReferences(viewDef, exclude=[v]))
+        parsed += 1
+    logging.info('parsed %s of %s view definitions' % (parsed, len(viewRefs)))
+
+    return viewRefs
+
+
+def getViewDepGraph(viewRefs):
+    """this will return a graph of table names associated with view definitions
+
+    Args:
+        viewRefs(dict): view names mapped to a (text hash, list of referenced table names) tuple (see getViewRefs)
+
+    Returns:
+        networkx.DiGraph: a directed graph of table names and associated views
+    """
+    G = nx.DiGraph()
+    for v, (_, tableNames) in viewRefs.items():
+        G.add_node(v)
+        for t in tableNames:
+            if t not in G.nodes():
+                G.add_node(t)
+            G.add_edge(t, v)
+
+    return G
+
@@ -0,0 +1,40 @@
+"""lazy evaluation utilities"""
+
+
+import threading
+
+
+class lazyProperty(object):
+    """this is a decorator for properties that are computed on first access and memoized on the instance.
+
+    Notes:
+        the first access is guarded by a lock so concurrent callers (i.e. a parallel warm up) compute the value once.
+        Each instance gets its own lock, so a slow getter on one instance doesn't hold up the others. Afterwards the
+        value lives in the instance's __dict__ and is returned without calling the getter again.
+    """
+
+    def __init__(self, func):
+        """init
+
+        Args:
+            func(function): the getter of the property
+        """
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+        self.lockName = '_%s_lock' % self.name
+        # this only guards handing out the per-instance locks
+        self.lock = threading.Lock()
+
+    def __get__(self, obj, objType=None):
+        """get"""
+        if obj is None:
+            return self
+        with self.lock:
+            lock = obj.__dict__.setdefault(self.lockName, threading.RLock())
+        with lock:
+            if self.name not in obj.__dict__:
+                obj.__dict__[self.name] = self.func(obj)
+                # once the value is set we never get here again, so the lock can go
+                obj.__dict__.pop(self.lockName, None)
+        return obj.__dict__[self.name]
@@ -0,0 +1,63 @@
+"""parquet utilities"""
+
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# this maps bq column types onto the arrow types we stage them as
+ARROW_TYPES = {'STRING': pa.string(),
+               'INTEGER': pa.int64(),
+               'FLOAT': pa.float64(),
+               'BOOLEAN': pa.bool_(),
+               'DATE': pa.date32(),
+               'TIMESTAMP': pa.timestamp('us', tz='UTC')}
+
+
+def getArrowSchema(fields):
+    """this will return an arrow schema for a list of bq column definitions
+
+    Args:
+        fields(list of tuple): a list of (column name, bq column type) pairs
+
+    Returns:
+        pyarrow.Schema: the corresponding arrow schema
+    """
+    return pa.schema([pa.field(name, ARROW_TYPES[bqType]) for (name, bqType) in fields])
+
+
+def toArrowTable(df, schema):
+    """this will convert a DataFrame into an arrow table with an explicit schema
+
+    Args:
+        df(DataFrame): the data you care about
+        schema(pyarrow.Schema): the schema to conform to (see getArrowSchema)
+
+    Returns:
+        pyarrow.Table: the arrow table, without the DataFrame index
+
+    Notes:
+        timestamps are normalized to UTC and datetimes are truncated to dates for DATE columns, since arrow won't
+        cast those implicitly.
+    """
+    df = df[schema.names].copy()
+    for field in schema:
+        if field.type == pa.date32():
+            df[field.name] = pd.to_datetime(df[field.name]).dt.date
+        elif isinstance(field.type, pa.TimestampType):
+            df[field.name] = pd.to_datetime(df[field.name], utc=True)
+
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+def writeParquet(df, fileName, schema, compression='snappy'):
+    """this will write a DataFrame to a compressed parquet file with an explicit schema
+
+    Args:
+        df(DataFrame): the data you care about
+        fileName(str): the path of the parquet file
+        schema(pyarrow.Schema): the schema to conform to (see getArrowSchema)
+        compression(str, optional): the parquet compression codec (defaults to 'snappy')
+    """
+    pq.write_table(toArrowTable(df, schema), fileName, compression=compression)
@@ -0,0 +1,111 @@
+"""schema utilities"""
+
+
+import datetime
+import json
+import logging
+import os
+from mikesnowflake.util.graphUtil import getTextHash
+
+
+def getTableDiff(oldTables, newTables):
+    """this will compare two lists of table names
+
+    Args:
+        oldTables(list of str): the previous table names
+        newTables(list of str): the current table names
+
+    Returns:
+        tuple: the sorted lists of added and removed table names
+    """
+    oldTables = set(oldTables)
+    newTables = set(newTables)
+    return sorted(newTables - oldTables), sorted(oldTables - newTables)
+
+
+def getSchemaDiff(oldTables, newTables, oldViews, newViews):
+    """this will compare two versions of the cached schema
+
+    Args:
+        oldTables(list of str): the previous table names
+        newTables(list of str): the current table names
+        oldViews(DataFrame): the previous view definitions with 'name' and 'text' columns
+        newViews(DataFrame): the current view definitions with 'name' and 'text' columns
+
+    Returns:
+        dict: the sorted lists of addedTables, removedTables, addedViews, removedViews and changedViews
+    """
+    addedTables, removedTables = getTableDiff(oldTables, newTables)
+    oldHashes = {v: getTextHash(text) for (v, text) in zip(oldViews['name'], oldViews['text'])}
+    newHashes = {v: getTextHash(text) for (v, text) in zip(newViews['name'], newViews['text'])}
+    addedViews, removedViews = getTableDiff(oldHashes, newHashes)
+    changedViews = sorted(v for v in newHashes if v in oldHashes and oldHashes[v] != newHashes[v])
+
+    return {'addedTables': addedTables, 'removedTables': removedTables,
+            'addedViews': addedViews, 'removedViews': removedViews, 'changedViews': changedViews}
+
+
+def appendSchemaChanges(journalFile, diff, tableHashes, viewHashes):
+    """this will append a schema diff to the change journal, one json line per update.
+
+    Args:
+        journalFile(str): the path of the journal (i.e. schema/changes.jsonl)
+        diff(dict): the schema diff (see getSchemaDiff)
+        tableHashes(tuple): the hashes of tables.csv before and after the update
+        viewHashes(tuple): the hashes of views.csv before and after the update
+    """
+    entry = {'ts': datetime.datetime.today().strftime('%Y-%m-%d %H:%M:%S'),
+             'tableHash': list(tableHashes),
+             'viewHash': list(viewHashes)}
+    entry.update(diff)
+    os.makedirs(os.path.dirname(journalFile), exist_ok=True)
+    with open(journalFile, 'a') as f:
+        f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    logging.info('%s tables added, %s removed, %s views added, %s removed, %s changed' %
+                 tuple(len(diff[k]) for k in ['addedTables', 'removedTables', 'addedViews', 'removedViews',
+                                              'changedViews']))
+
+
+def readSchemaChanges(journalFile):
+    """this will read the change journal
+
+    Args:
+        journalFile(str): the path of the journal
+
+    Returns:
+        list of dict: the journal entries, oldest first
+    """
+    if not os.path.exists(journalFile):
+        return []
+    with open(journalFile) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def getTableChanges(journalFile, fromHash, toHash):
+    """this will return the table names added or removed between two versions of tables.csv
+
+    Args:
+        journalFile(str): the path of the journal
+        fromHash(str): the hash of the earlier tables.csv
+        toHash(str): the hash of the later tables.csv
+
+    Returns:
+        set of str: the table names added or removed along the way, or None if the journal doesn't connect the versions
+
+    Notes:
+        a table that was added and then removed again is still reported, which is harmless for invalidation.
+    """
+    if fromHash == toHash:
+        return set()
+    changes = set()
+    currentHash = fromHash
+    for entry in readSchemaChanges(journalFile):
+        if entry['tableHash'][0] != currentHash:
+            continue
+        changes.update(entry['addedTables'])
+        changes.update(entry['removedTables'])
+        currentHash = entry['tableHash'][1]
+        if currentHash == toHash:
+            return changes
+
+    return None
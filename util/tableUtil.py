@@ -0,0 +1,279 @@
+"""table name utilities"""
+
+
+import hashlib
+import multiprocessing
+import re
+import threading
+from array import array
+from collections import ChainMap, deque
+from concurrent.futures import ProcessPoolExecutor
+
+
+# these are the parts of a query that vary between runs of the same sql but can't be part of a table name
+WHITESPACE = re.compile(r'\s+')
+NUMERIC_LITERAL = re.compile(r'\b\d+(\.\d+)?\b')
+STRING_LITERAL = re.compile(r"'[^a-z']*'")
+
+# this is what forked attribution workers inherit, so the index and the texts are never pickled. The lock keeps
+# concurrent callers from swapping it out from under each other's workers.
+SHARED = {}
+SHARED_LOCK = threading.Lock()
+
+
+def getQueryFingerprint(text):
+    """this will return a fingerprint of a sql text that is shared by the runs of the same query shape.
+
+    Args:
+        text(str): the sql text you care about
+
+    Returns:
+        str: the md5 hex digest of the normalized text
+
+    Notes:
+        we lowercase the text, collapse whitespace, and replace standalone numbers and string literals without letters
+        (i.e. dates) with a placeholder. None of these can change which table names are found in the text.
+    """
+    text = WHITESPACE.sub(' ', text.lower())
+    text = NUMERIC_LITERAL.sub('?', text)
+    text = STRING_LITERAL.sub("'?'", text)
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class TableNameIndex(object):
+    """this is an aho-corasick automaton over snowflake table names used to find table references in sql text.
+
+    Notes:
+        The automaton is built once from the table list and every text is lowercased and scanned once, regardless of the
+        number of tables. Table names that are contained in other table names (i.e. "DIM_SITES" and "DIM_SITES_TO_OWNERS")
+        are resolved by keeping only the longest names found, which is the same attribution rule we've always used.
+    """
+
+    def __init__(self, tableNames):
+        """init
+
+        Args:
+            tableNames(list of str): the universe of table names (i.e. SnowFlakeAccess.getTables())
+        """
+        self.tableNames = list(tableNames)
+        self.__positions = {tableName: i for (i, tableName) in enumerate(self.tableNames)}
+
+        # goto transitions, failure links and pattern outputs for each automaton state
+        self.__goto = [{}]
+        self.__fail = [0]
+        self.__out = [[]]
+        self.__build()
+
+        self.embeddedTableNames = self.__getEmbeddedTableNames()
+
+    def __build(self):
+        """this is an internal method to build the trie and its failure links
+        """
+        for i, tableName in enumerate(self.tableNames):
+            state = 0
+            for char in tableName.lower():
+                nextState = self.__goto[state].get(char)
+                if nextState is None:
+                    nextState = len(self.__goto)
+                    self.__goto.append({})
+                    self.__fail.append(0)
+                    self.__out.append([])
+                    self.__goto[state][char] = nextState
+                state = nextState
+            self.__out[state].append(i)
+
+        # breadth first pass to set the failure links, merging outputs along the way
+        queue = deque(self.__goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nextState in self.__goto[state].items():
+                queue.append(nextState)
+                fail = self.__fail[state]
+                while fail and char not in self.__goto[fail]:
+                    fail = self.__fail[fail]
+                self.__fail[nextState] = self.__goto[fail].get(char, 0)
+                self.__out[nextState] = self.__out[nextState] + self.__out[self.__fail[nextState]]
+
+    def __scan(self, text):
+        """this is an internal method that returns the positions of all table names found in lowercased text
+        """
+        goto = self.__goto
+        fail = self.__fail
+        out = self.__out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def __getEmbeddedTableNames(self):
+        """this is an internal method to obtain the table names that contain other table names.
+
+        Notes:
+            we run each table name through the automaton rather than comparing every pair of tables.
+        """
+        embeddedTableNames = {}  # this will be a dictionary of table names that contain themselves in other table names
+        for i, t2 in enumerate(self.tableNames):
+            for j in sorted(self.__scan(t2.lower())):
+                t1 = self.tableNames[j]
+                if t1 in t2 and t1 != t2:
+                    embeddedTableNames.setdefault(t1, []).append(t2)
+
+        return embeddedTableNames
+
+    def findTables(self, text):
+        """this will return every table name found in a given text, including names embedded in longer names.
+
+        Args:
+            text(str): the sql text you care about
+
+        Returns:
+            list of str: the table names found, in the order of self.tableNames
+        """
+        return [self.tableNames[i] for i in sorted(self.__scan(text.lower()))]
+
+    def findReferences(self, text, tableNames=None, exclude=None):
+        """this will return the tables referenced by a given text.
+
+        Args:
+            text(str): the sql text you care about
+            tableNames(list of str, optional): restricts the results to these table names (defaults to all tables)
+            exclude(list of str, optional): table names to disregard entirely, i.e. a view's own name in its definition
+
+        Returns:
+            list of str: the referenced table names, in the order of self.tableNames
+
+        Notes:
+            a table is dropped if any of the longer table names that contain it are also found in the text.
+        """
+        found = self.__scan(text.lower())
+        if exclude:
+            found.difference_update(self.__positions[name] for name in exclude if name in self.__positions)
+
+        return [self.tableNames[i] for i in self.__getReferences(found, self.__getAllowed(tableNames))]
+
+    def findReferencesMany(self, texts, tableNames=None, cache=None):
+        """this will find the tables referenced by many texts, collecting the results in compact columnar buffers.
+
+        Args:
+            texts(iterable of str): the sql texts you care about (i.e. a column of query text)
+            tableNames(list of str, optional): restricts the results to these table names (defaults to all tables)
+            cache(dict, optional): query fingerprints mapped to the positions of their referenced table names, which is
+                read and updated in place. It is only valid for this index's table names. Every fingerprint we see is
+                moved to the end, so the dict stays in least recently used order.
+
+        Returns:
+            tuple: two equal length array.array('q') buffers, holding the position of the text and the position of the
+                referenced table name in self.tableNames for each reference. See findReferences.
+        """
+        allowed = self.__getAllowed(tableNames)
+        rows = array('q')
+        tables = array('q')
+        for row, text in enumerate(texts):
+            if cache is None:
+                refs = self.__getReferences(self.__scan(text.lower()), allowed)
+            else:
+                # we only scan texts whose query shape we haven't seen before
+                fingerprint = getQueryFingerprint(text)
+                refs = cache.get(fingerprint)
+                if refs is None:
+                    refs = tuple(self.__getReferences(self.__scan(text.lower()), None))
+                else:
+                    cache.pop(fingerprint, None)
+                cache[fingerprint] = refs
+                if allowed is not None:
+                    refs = [i for i in refs if i in allowed]
+            rows.extend([row] * len(refs))
+            tables.extend(refs)
+
+        return rows, tables
+
+    def findReferencesParallel(self, texts, tableNames=None, cache=None, processes=None, shards=None):
+        """this is the multiprocess version of findReferencesMany for large batches of texts.
+
+        Args:
+            texts(sequence of str): the sql texts you care about (i.e. a column of query text)
+            tableNames(list of str, optional): restricts the results to these table names (defaults to all tables)
+            cache(dict, optional): query fingerprints mapped to referenced table positions. See findReferencesMany.
+            processes(int, optional): the number of worker processes (defaults to the number of cpus)
+            shards(int, optional): the number of contiguous ranges the texts are split into (defaults to 4 per process)
+
+        Returns:
+            tuple: the same buffers findReferencesMany would return
+
+        Notes:
+            the workers are forked after the index, the texts and the cache are in place, so each task only sends a
+            range of rows and gets back its references along with the fingerprints it matched, which we merge in order.
+            Forking isn't safe while other threads may hold locks, so call this from a single threaded process.
+        """
+        processes = processes or multiprocessing.cpu_count()
+        shards = shards or processes * 4
+        if processes <= 1 or len(texts) < shards:
+            return self.findReferencesMany(texts, tableNames=tableNames, cache=cache)
+
+        bounds = [len(texts) * i // shards for i in range(shards + 1)]
+        with SHARED_LOCK:
+            SHARED['args'] = (self, texts, tableNames, cache)
+            try:
+                with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as pool:
+                    results = list(pool.map(findReferencesShard, bounds[:-1], bounds[1:]))
+            finally:
+                SHARED.clear()
+
+        rows = array('q')
+        tables = array('q')
+        for shardRows, shardTables, fingerprints in results:
+            rows.extend(shardRows)
+            tables.extend(shardTables)
+            if cache is not None:
+                # the shards saw these fingerprints last, so they move to the end in order
+                for fingerprint, refs in fingerprints.items():
+                    cache.pop(fingerprint, None)
+                    cache[fingerprint] = refs
+
+        return rows, tables
+
+    def __getAllowed(self, tableNames):
+        """this is an internal method that returns the positions of the table names to keep, or None to keep all
+        """
+        if tableNames is None:
+            return None
+        return {self.__positions[name] for name in tableNames if name in self.__positions}
+
+    def __getReferences(self, found, allowed):
+        """this is an internal method that returns the sorted positions of the found names that aren't embedded in
+        other found names
+        """
+        refs = []
+        for i in sorted(found):
+            if allowed is not None and i not in allowed:
+                continue
+            if any(self.__positions[name] in found for name in self.embeddedTableNames.get(self.tableNames[i], [])):
+                continue
+            refs.append(i)
+
+        return refs
+
+
+def findReferencesShard(start, stop):
+    """this is the task of a forked findReferencesParallel worker
+
+    Args:
+        start(int): the position of the first text in the shard
+        stop(int): the position after the last text in the shard
+
+    Returns:
+        tuple: the row and table position buffers of the shard, and the fingerprints it saw in the order it last saw them
+    """
+    tableIndex, texts, tableNames, cache = SHARED['args']
+    fingerprints = {}
+    if cache is not None:
+        # the fingerprints we see land in our own dict, which is all we send back
+        cache = ChainMap(fingerprints, cache)
+    rows, tables = tableIndex.findReferencesMany(texts[start:stop], tableNames=tableNames, cache=cache)
+
+    return array('q', [row + start for row in rows]), tables, fingerprints
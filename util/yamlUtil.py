@@ -2,16 +2,30 @@
 
 
 import yaml
+import hashlib
 import logging
 import os
-import subprocess
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
-from mikesnowflake.access.snowFlakeAccess import SnowFlakeAccess
+from mikesnowflake.access.snowFlakeAccess import SnowFlakeAccess, CACHE_DIR
+from mikesnowflake.util.cacheUtil import getFileHash, loadPickle, dumpPickle
+from mikesnowflake.util.schemaUtil import getTableDiff
+from mikesnowflake.util.tableUtil import TableNameIndex
 
 # snowflake credentials
 USER = ''
 PASSWORD = ''
 
+# we use the libyaml C loader whenever PyYAML was built with it, since it is much faster than the pure python one
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+# this is where we keep parsed yaml configs, keyed by file path and modified time
+YAML_CACHE_FILE = os.path.join(CACHE_DIR, 'jobs', 'yamlCache.pkl')
+
+# this is the fewest stale files we bother to fan out over a process pool
+MIN_POOL_FILES = 8
+
 
 def getNestedVals(searchObj):
     """
@@ -39,28 +53,219 @@ def getYamlConfig(fileName):
     """
     data = None
     with open(fileName) as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
+        data = yaml.load(f, Loader=YAML_LOADER)
     return data
 
-def getYamlDependencies(workSpace, snowFlakeTables=None, user=USER, password=PASSWORD):
+
+def getYamlConfigs(fileNames, workers=None, cacheFile=YAML_CACHE_FILE, refresh=False):
+    """this will parse many yaml files, reusing previously parsed configs for files that haven't changed.
+
+    Args:
+        fileNames(list of str): the yaml files you care about
+        workers(int, optional): the number of processes used to parse changed files (defaults to the cpu count)
+        cacheFile(str, optional): the pickled cache of parsed configs (None disables the cache)
+        refresh(bool, optional): parses every file again when True, still writing the results to the cache
+
+    Returns:
+        dict: the parsed config of each file name
+
+    Notes:
+        a cached config is reused when the file's modified time and size are unchanged. Changed files are parsed
+        on a process pool when there are enough of them to be worth it, but only from a single threaded process,
+        since the pool forks and forking while other threads hold locks (i.e. SnowFlakeAnalysis.warm) can deadlock.
     """
+    cache = (loadPickle(cacheFile) if cacheFile else None) or {}
+    configs = {}
+    stale = []
+    for fileName in fileNames:
+        stat = os.stat(fileName)
+        key = os.path.abspath(fileName)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if not refresh and key in cache and cache[key][0] == stamp:
+            configs[fileName] = cache[key][1]
+        else:
+            stale.append((fileName, key, stamp))
+
+    if len(stale) == 0:
+        return configs
+
+    staleFiles = [fileName for (fileName, _, _) in stale]
+    singleThreaded = threading.current_thread() is threading.main_thread() and threading.active_count() == 1
+    if len(stale) >= MIN_POOL_FILES and singleThreaded:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed = list(pool.map(getYamlConfig, staleFiles, chunksize=max(1, len(stale) // 32)))
+    else:
+        parsed = [getYamlConfig(fileName) for fileName in staleFiles]
+    logging.info('parsed %s of %s yaml files' % (len(stale), len(fileNames)))
+
+    for (fileName, key, stamp), data in zip(stale, parsed):
+        configs[fileName] = data
+        cache[key] = (stamp, data)
+    if cacheFile:
+        # we drop configs of files that no longer exist so the cache doesn't grow forever
+        cache = {key: value for (key, value) in cache.items() if os.path.exists(key)}
+        dumpPickle(cache, cacheFile)
+
+    return configs
+
+
+def getYamlFileTables(repoDir, tableIndex, previous=None, addedTables=None, removedTables=None):
+    """this will walk a repository once and return the table names found in the text of each yaml file.
+
+    Args:
+        repoDir(str): the path of the repository checkout
+        tableIndex(TableNameIndex): the index of table names
+        previous(dict, optional): the results of a previous call
+        addedTables(list of str, optional): the table names added to the index since the previous call
+        removedTables(list of str, optional): the table names removed from the index since the previous call
+
+    Returns:
+        dict: yaml file paths mapped to a (content hash, set of table names found) tuple
+
+    Notes:
+        a table is found in a file the same way "grep -l -i -R <table name> <repoDir>" would find it, including names
+        embedded in longer names. Files whose content hash matches the previous results aren't matched again, we only
+        look for the added table names in them.
     """
+    previous = previous or {}
+    addedTables = [(t, t.lower()) for t in (addedTables or [])]
+    removedTables = set(removedTables or [])
+    fileTables = {}
+    matched = 0
+    for root, _, files in os.walk(repoDir, followlinks=True):
+        for name in files:
+            if not name.endswith('.yaml'):
+                continue
+            fileName = os.path.join(root, name)
+            with open(fileName, 'rb') as f:
+                content = f.read()
+            contentHash = hashlib.md5(content).hexdigest()
 
-    if not snowFlakeTables:
-        sfa = SnowFlakeAccess(user, password)
-        snowFlakeTables = sfa.getTables()
+            # we only lowercase ascii like grep does, and latin-1 maps every byte to a character
+            if fileName in previous and previous[fileName][0] == contentHash:
+                tableNames = previous[fileName][1]
+                if addedTables or removedTables:
+                    text = content.lower().decode('latin-1')
+                    tableNames = (tableNames - removedTables) | {t for (t, lower) in addedTables if lower in text}
+                fileTables[fileName] = (contentHash, tableNames)
+                continue
+
+            text = content.lower().decode('latin-1')
+            fileTables[fileName] = (contentHash, set(tableIndex.findTables(text)))
+            matched += 1
+    logging.info('indexed %s of %s yaml files in %s' % (matched, len(fileTables), repoDir))
+
+    return fileTables
+
+
+def getYamlStatements(data):
+    """this will collect the sql statements of a yaml config along with its feed metadata.
+
+    Args:
+        data(object): the parsed yaml config
+
+    Returns:
+        tuple: the feed name, feed location, load state variable and list of sql statements
+
+    Raises:
+        ValueError: if the config has no statements and isn't a retry config
+    """
+    loadStateVar = None
+    feedName = None
+    feedLocation = None
+    if isinstance(data, dict):
+        loadStateVar = data.get('LOAD_STATE_VAR')
+        feedName = data.get('FEED_NAME')
+        feedLocation = data.get('FEED_LOCATION')
+        skipKeys = ['LOAD_STATE_VAR', 'FEED_NAME', 'FEED_LOCATION']
+        data = {k: v for (k, v) in data.items() if k not in skipKeys}
 
-    embeddedTableNames = {}  # this will be a dictionary of table names that contain themselves in other table names
-    for t1 in snowFlakeTables:
-        for t2 in snowFlakeTables:
-            if t1 in t2 and t1 != t2:
-                if t1 not in embeddedTableNames:
-                    embeddedTableNames[t1] = []
-                embeddedTableNames[t1].append(t2)    
+    # collect all sql statements in the yaml file in its various forms
+    statements = getNestedVals(data)
+    if len(statements) == 0:
+        if sorted(data.keys()) != ['MAX_ATTEMPTS', 'WAIT_BETWEEN_ATTEMPTS']:
+            raise ValueError('no statements found')
+
+    # append extra information about salesforce tables, which can't be auto-parsed
+    if isinstance(data, dict) and 'SF_OBJECT_NAMES' in data:
+        statements.extend(['SF_%s' % sfName.upper() for sfName in data['SF_OBJECT_NAMES']])
+
+    return feedName, feedLocation, loadStateVar, statements
+
+
+def isTableInStatements(tableName, statements, tableIndex):
+    """this will check whether any of a yaml config's sql statements references a table.
+
+    Args:
+        tableName(str): the table name you care about
+        statements(list of tuple): the lowercased statements with the set of table names found in each
+        tableIndex(TableNameIndex): the index of table names
+
+    Returns:
+        bool: True if a statement references the table
+    """
+    for stmt, found in statements:
+        # we skip statements that only reference the table's tmp version
+        if tableName not in found or '%s_tmp' % tableName.lower() in stmt:
+            continue
+
+        # this catches attribution for instances like "DIM_SITES" and "DIM_SITES_TO_OWNERS".
+        # we exclude salesforce tables from this analysis, since they are uniquely configured in an env.yaml file
+        if tableName.startswith('SF_'):
+            return True
+        if not any(name in found for name in tableIndex.embeddedTableNames.get(tableName, [])):
+            return True
+
+    return False
+
+
+def getYamlDependencies(workSpace, snowFlakeTables=None, user=USER, password=PASSWORD, stateFile=None, full=False):
+    """this will find the yaml configs in the etl repos that reference each snowflake table.
+
+    Args:
+        workSpace(str): the directory containing the data-sustain-snowflake-etl and -wheels checkouts
+        snowFlakeTables(list of str, optional): the table names you care about (defaults to SnowFlakeAccess.getTables())
+        user(str, optional): snowflake username
+        password(str, optional): snowflake password
+        stateFile(str, optional): a pickle of per-file results from the previous run, for an incremental refresh
+        full(bool, optional): ignores the previous state and parsed yaml cache when True, still writing fresh ones
+
+    Returns:
+        DataFrame: the table_name, feed_name, feed_location, load_state_var, repo and file of each reference
+
+    Notes:
+        we walk the repo and parse each yaml file once, then match the table index against its statements.
+        With a state file, only yaml files that are new or whose content hash changed are matched and parsed again.
+        When the table list changed, we keep the state and only look for the added table names in the unchanged files.
+    """
+    if not snowFlakeTables:
+        with SnowFlakeAccess(user, password) as sfa:
+            tableIndex = sfa.getTableIndex()
+        snowFlakeTables = tableIndex.tableNames
+    else:
+        tableIndex = TableNameIndex(snowFlakeTables)
 
     gitSustainDir = os.path.join(workSpace, 'data-sustain-snowflake-etl')
     gitWheelsDir = os.path.join(workSpace, 'data-sustain-snowflake-wheels')
+
+    # the previous run's per-file results are adjusted for the table names that were added or removed since
+    state = (loadPickle(stateFile) if stateFile and not full else None) or {}
+    addedTables, removedTables = getTableDiff(state.get('tableNames', []), snowFlakeTables)
+    if not state:
+        addedTables, removedTables = [], []
+    elif addedTables or removedTables:
+        logging.info('%s tables added and %s removed since the last run' % (len(addedTables), len(removedTables)))
+
+    # index the table names found in every yaml file in a single pass
+    fileTables = getYamlFileTables(gitSustainDir, tableIndex, previous=state.get('fileTables'),
+                                   addedTables=addedTables, removedTables=removedTables)
+    tableFiles = {}
+    for yamlFile, (_, tableNames) in fileTables.items():
+        for tableName in tableNames:
+            tableFiles.setdefault(tableName, []).append(yamlFile)
+
     res = []
+    tableYamlFiles = []
     for tableName in snowFlakeTables:
         # special handling for DOWNLOAD_STATE table, since it's not yet in git but is a prod
         # process according to sigmoid (i.e. nuthan)
@@ -87,12 +292,9 @@ def getYamlDependencies(workSpace, snowFlakeTables=None, user=USER, password=PAS
         if tableName == 'MONITOR_SF_LOAD':
             pyFile = 'data-sustain-snowflake-wheels/py-salesforce-pull/ox_dw_snowflake_salesforce_pull/settings.py'
             logging.warning('**SPECIAL CASE** %s found in %s' % (tableName, pyFile))
-            res.append([tableName, None, None, None, 'data-sustain-snowflake-wheels', pyFile])            
+            res.append([tableName, None, None, None, 'data-sustain-snowflake-wheels', pyFile])
 
-        cmd = ['grep', tableName, '-l', '-i', '-R', '%s' % gitSustainDir]
-        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        out = p.communicate()[0].decode().split('\n')
-        yamlFiles = sorted(list(set(f for f in out if f.endswith('.yaml'))))
+        yamlFiles = sorted(tableFiles.get(tableName, []))
 
         # salesforce tables reference the env yaml file. So we use the sample env file as a proxy.
         if tableName.startswith('SF_'):
@@ -112,46 +314,50 @@ def getYamlDependencies(workSpace, snowFlakeTables=None, user=USER, password=PAS
                                     'ox_dw_snowflake_odfi_etl', 'app_config', 'rollup.yaml')
             yamlFiles.append(yamlFile)
 
+        tableYamlFiles.append((tableName, len(res), yamlFiles))
+
+    # parse each referenced yaml file once and find the tables in each of its statements
+    yamlFiles = sorted(set(f for (_, _, yamlFiles) in tableYamlFiles for f in yamlFiles))
+    previous = state.get('parsed', {})
+    parsed = {}
+    staleFiles = []
+    for yamlFile in yamlFiles:
+        contentHash = fileTables[yamlFile][0] if yamlFile in fileTables else getFileHash(yamlFile)
+        if yamlFile in previous and previous[yamlFile][0] == contentHash:
+            parsed[yamlFile] = previous[yamlFile]
+            if addedTables or removedTables:
+                feedName, feedLocation, loadStateVar, statements = previous[yamlFile][1]
+                statements = [(stmt, (found - set(removedTables)) | {t for t in addedTables if t.lower() in stmt})
+                              for (stmt, found) in statements]
+                parsed[yamlFile] = (contentHash, (feedName, feedLocation, loadStateVar, statements))
+        else:
+            staleFiles.append((yamlFile, contentHash))
+
+    configs = getYamlConfigs([yamlFile for (yamlFile, _) in staleFiles], refresh=full)
+    for yamlFile, contentHash in staleFiles:
+        feedName, feedLocation, loadStateVar, statements = getYamlStatements(configs[yamlFile])
+        statements = [(stmt.lower(), set(tableIndex.findTables(stmt))) for stmt in statements]
+        parsed[yamlFile] = (contentHash, (feedName, feedLocation, loadStateVar, statements))
+    logging.info('matched statements in %s of %s referenced yaml files' % (len(staleFiles), len(yamlFiles)))
+
+    if stateFile:
+        dumpPickle({'tableNames': list(snowFlakeTables), 'fileTables': fileTables, 'parsed': parsed}, stateFile)
+
+    # we insert each table's rows after any special case rows that came before it
+    tableRes = []
+    for tableName, pos, yamlFiles in tableYamlFiles:
+        rows = []
         for yamlFile in yamlFiles:
-            data = getYamlConfig(yamlFile)
-
-            loadStateVar = None
-            feedName = None
-            feedLocation = None
-            if isinstance(data, dict):
-                loadStateVar = data.get('LOAD_STATE_VAR')
-                feedName = data.get('FEED_NAME')
-                feedLocation = data.get('FEED_LOCATION')
-                skipKeys = ['LOAD_STATE_VAR', 'FEED_NAME', 'FEED_LOCATION']
-                data = {k: v for (k, v) in data.items() if k not in skipKeys}
-
-            # collect all sql statements in the yaml file in its various forms
-            statements = getNestedVals(data)
-            if len(statements) == 0:
-                if sorted(data.keys()) != ['MAX_ATTEMPTS', 'WAIT_BETWEEN_ATTEMPTS']:
-                    raise ValueError('no statements found')
-
-            # append extra information about salesforce tables, which can't be auto-parsed
-            if isinstance(data, dict) and 'SF_OBJECT_NAMES' in data:
-                statements.extend(['SF_%s' % sfName.upper() for sfName in data['SF_OBJECT_NAMES']])
-            # reduce statements that reference the table
-            statements = [stmt for stmt in statements if (tableName.lower() in stmt.lower() or '%s ' % tableName.lower() in stmt.lower()) and '%s_tmp' % tableName.lower() not in stmt.lower()]
-            if len(statements) > 0:
-                count = 0 # a counter to see if the table is found after iterating through all statements
-                for sql in statements:
-                    # this catches attribution for instances like "DIM_SITES" and "DIM_SITES_TO_OWNERS".
-                    # we exclude salesforce tables from this analysis, since they are uniquely configured in an env.yaml file
-                    status = True
-                    if tableName in embeddedTableNames and not tableName.startswith('SF_'):
-                        otherFound = [name for name in embeddedTableNames[tableName] if name.lower() in sql.lower()]
-                        if len(otherFound) > 0:
-                            status = False
-                    count += status
-                if count > 0:
-                    yamlFile = yamlFile.replace(workSpace, '')
-                    yamlRepo = yamlFile.split('/')[0]
-                    res.append([tableName, feedName, feedLocation, loadStateVar, yamlRepo, yamlFile])
-                    logging.info('%s found in %s' % (tableName, yamlFile))
+            feedName, feedLocation, loadStateVar, statements = parsed[yamlFile][1]
+            if isTableInStatements(tableName, statements, tableIndex):
+                yamlFile = yamlFile.replace(workSpace, '')
+                yamlRepo = yamlFile.split('/')[0]
+                rows.append([tableName, feedName, feedLocation, loadStateVar, yamlRepo, yamlFile])
+                logging.info('%s found in %s' % (tableName, yamlFile))
+        tableRes.append((pos, rows))
+    for pos, rows in reversed(tableRes):
+        res[pos:pos] = rows
+
     cols = ['table_name', 'feed_name', 'feed_location', 'load_state_var', 'repo', 'file']
     df = pd.DataFrame(res, columns=cols)
 